@@ -0,0 +1,597 @@
+import argparse
+import asyncio
+import datetime
+import io
+import itertools
+import logging
+import os
+import random
+import re
+import string
+import sys
+import tempfile
+import time
+import types
+
+# Run against a throwaway working directory so the benchmark never touches the real data files
+os.chdir(tempfile.mkdtemp(prefix='calliope-bench-'))
+with open('.env', 'w') as env_file:
+    env_file.write("TOKEN=\nVOUCH_CHANNEL=1\nDUE=86400\nCATEGORY=2\nMODERATOR=3\n")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import calliope  # noqa: E402
+import discord  # noqa: E402
+
+
+def report(name, count, elapsed):
+    print(f"{name:<40} {count:>8} ops  {elapsed * 1000:>9.2f} ms  {count / elapsed:>12,.0f} ops/s")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0
+
+
+def report_latencies(name, latencies, elapsed, rss_before):
+    print(f"{name:<40} {len(latencies):>8} ops  {len(latencies) / elapsed:>9,.0f} ops/s  "
+          f"p50 {percentile(latencies, 0.5) * 1000:>8.2f} ms  p99 {percentile(latencies, 0.99) * 1000:>8.2f} ms  "
+          f"rss +{(calliope.resident_memory() - rss_before) / 2 ** 20:.1f} MiB")
+
+
+# Fake Discord
+# Just enough of the gateway and REST surface for calliope's handlers. Every REST call waits `latency`
+# seconds, and every `rate_limit_every`-th call is first answered with a 429: it is logged like
+# discord.http does and retried after `retry_after` seconds.
+
+snowflakes = itertools.count(10 ** 17)
+
+
+class FakeRest:
+    def __init__(self, latency=0.0, rate_limit_every=0, retry_after=0.05):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.calls = 0
+        self.rate_limited = 0
+
+    async def call(self):
+        self.calls += 1
+        if self.rate_limit_every and self.calls % self.rate_limit_every == 0:
+            self.rate_limited += 1
+            logging.getLogger('discord.http').warning(
+                'We are being rate limited. Retrying in %.2f seconds. Handled under the bucket "%s"',
+                self.retry_after, 'fake')
+            await asyncio.sleep(self.retry_after)
+        await asyncio.sleep(self.latency)
+
+
+rest = FakeRest()
+
+
+class FakeGateway:
+    def __init__(self):
+        self.channels = {}
+
+    def get_channel(self, channel_id):
+        return self.channels.get(int(channel_id))
+
+
+gateway = FakeGateway()
+
+
+class FakeRole:
+    def __init__(self, name):
+        self.id = next(snowflakes)
+        self.name = name
+        self.mention = f"<@&{self.id}>"
+
+
+class FakeMember:
+    def __init__(self, guild, roles=(), administrator=False):
+        self.id = next(snowflakes)
+        self.guild = guild
+        self.name = f"member{self.id}"
+        self.mention = f"<@{self.id}>"
+        self.roles = list(roles)
+        self.guild_permissions = types.SimpleNamespace(administrator=administrator)
+        self.direct_messages = []
+        guild.members[self.id] = self
+
+    async def send(self, content=None, **kwargs):
+        await rest.call()
+        self.direct_messages.append(content)
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None, author=None, attachments=()):
+        self.id = next(snowflakes)
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.author = author
+        self.attachments = list(attachments)
+        self.embeds = [embed] if embed is not None else []
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.jump_url = f"https://discord.com/channels/{channel.guild.id}/{channel.id}/{self.id}"
+        self.edits = []  # (time, embed)
+
+    async def edit(self, embed=None, **kwargs):
+        await rest.call()
+        self.edits.append((time.perf_counter(), embed))
+        self.channel.edits.append((time.perf_counter(), embed))
+
+    async def add_reaction(self, emoji):
+        await rest.call()
+
+    async def clear_reactions(self):
+        await rest.call()
+
+    async def delete(self):
+        await rest.call()
+
+    async def pin(self):
+        await rest.call()
+
+
+class FakeChannel:
+    def __init__(self, guild, name):
+        self.id = next(snowflakes)
+        self.guild = guild
+        self.name = name
+        self.mention = f"<#{self.id}>"
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self._overwrites = []
+        self.text_channels = []  # When used as a category
+        self.sent = []  # (time, message)
+        self.edits = []  # (time, embed) of any message in the channel
+        gateway.channels[self.id] = self
+
+    async def send(self, content=None, embed=None, **kwargs):
+        await rest.call()
+        message = FakeMessage(self, content, embed, author=calliope.bot.user)
+        self.sent.append((time.perf_counter(), message))
+        return message
+
+    def get_partial_message(self, message_id):
+        message = FakeMessage(self)
+        message.id = message_id
+        return message
+
+    async def history(self, limit=None, oldest_first=False):
+        await rest.call()
+        messages = [message for _, message in self.sent]
+        for message in (messages if oldest_first else messages[::-1])[:limit]:
+            yield message
+
+    async def delete(self):
+        await rest.call()
+        gateway.channels.pop(self.id, None)
+        if self in self.guild.category.text_channels:
+            self.guild.category.text_channels.remove(self)
+
+
+class FakeOverwrite:
+    def __init__(self, target):
+        self.id = target.id
+        self.member = isinstance(target, FakeMember)
+
+    def is_member(self):
+        return self.member
+
+
+class FakeGuild:
+    def __init__(self):
+        self.id = next(snowflakes)
+        self.name = "Benchmark"
+        self.unavailable = False
+        self.members = {}
+        self.default_role = FakeRole("@everyone")
+        self.moderator_role = FakeRole("Moderator")
+        self.roles = [self.default_role, self.moderator_role]
+        self.owner = FakeMember(self, administrator=True)
+        self.owner_id = self.owner.id
+        self.category = FakeChannel(self, "tickets")
+        self.vouch_channel = FakeChannel(self, "vouches")
+        self.ticket_channels = []
+
+        calliope.bot._connection._guilds[self.id] = self
+        guild_config = calliope.get_guild_state(self.id).config
+        guild_config.set('moderator', self.moderator_role.id)
+        guild_config.set('category', self.category.id)
+        guild_config.set('vouch_channel', self.vouch_channel.id)
+
+    def get_channel(self, channel_id):
+        return gateway.get_channel(channel_id)
+
+    def get_role(self, role_id):
+        return discord.utils.get(self.roles, id=role_id)
+
+    def get_member(self, user_id):
+        return None  # Nothing is cached, like the lean profile
+
+    async def fetch_member(self, user_id):
+        await rest.call()
+        return self.members[user_id]
+
+    async def create_text_channel(self, name, overwrites=None, category=None):
+        await rest.call()
+        channel = FakeChannel(self, name)
+        channel._overwrites = [FakeOverwrite(target) for target in overwrites or {}]
+        self.ticket_channels.append(channel)
+        self.category.text_channels.append(channel)
+        return channel
+
+
+class FakeResponse:
+    async def edit_message(self, **kwargs):
+        await rest.call()
+
+    async def send_message(self, *args, **kwargs):
+        await rest.call()
+
+    async def send_modal(self, modal):
+        await rest.call()
+
+
+class FakeFollowup:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def send(self, content=None, embed=None, wait=False, **kwargs):
+        await rest.call()
+        return FakeMessage(self.channel, content, embed)
+
+    async def edit_message(self, message_id, **kwargs):
+        await rest.call()
+
+
+class FakeInteraction:
+    def __init__(self, user, channel, custom_id):
+        self.id = next(snowflakes)
+        self.type = discord.InteractionType.component
+        self.user = user
+        self.guild = user.guild
+        self.guild_id = user.guild.id
+        self.channel = channel
+        self.message = None
+        self.data = {'custom_id': custom_id}
+        self.response = FakeResponse()
+        self.followup = FakeFollowup(channel)
+
+
+class FakeContext:
+    # The slice of ApplicationContext used by send_warranty
+    def __init__(self, user, channel):
+        self.user = self.author = user
+        self.guild = user.guild
+        self.channel = channel
+
+    async def respond(self, *args, **kwargs):
+        await rest.call()
+
+
+class FakeAttachment:
+    def __init__(self, filename, seed):
+        self.filename = filename
+        self.url = f"https://cdn.discordapp.com/attachments/{seed}/{filename}"
+        self.data = fake_screenshot(seed)
+        self.size = len(self.data)
+
+
+def fake_screenshot(seed):
+    # A different picture for every seed; only drawn when Pillow is there to hash it
+    if calliope.Image is None:
+        return b""
+    image = calliope.Image.effect_noise((96, 96), 64).point(lambda value: (value * (seed % 7 + 1)) % 256)
+    output = io.BytesIO()
+    image.save(output, "PNG")
+    return output.getvalue()
+
+
+async def read_attachment(attachment):
+    await rest.call()
+    return attachment.data
+
+
+def install_fakes():
+    calliope.bot.get_channel = gateway.get_channel
+    calliope.read_attachment = read_attachment
+    calliope.bot._connection.user = types.SimpleNamespace(id=next(snowflakes))
+
+
+async def wait_until(predicate, timeout=120):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("The workload did not settle in time")
+        await asyncio.sleep(0.001)
+
+
+def reference_code_of(embed):
+    return re.search(r"Reference code: `(\w+)`", embed.description).group(1)
+
+
+# Workloads
+
+async def bench_drop(buyers=500, stock=100):
+    # A drop: every buyer presses Confirm on the same item at once, through the component router
+    guild = FakeGuild()
+    state = calliope.get_guild_state(guild.id)
+    state.stock_store.set("Limited Drop", stock)
+    custom_id = f"buy:{calliope.item_key('Limited Drop')}"
+    workers = [asyncio.create_task(calliope.ticket_worker()) for _ in range(calliope.TICKET_WORKERS)]
+    shop = FakeChannel(guild, "shop")
+    rss_before = calliope.resident_memory()
+
+    async def confirm(member):
+        started = time.perf_counter()
+        await calliope.on_interaction(FakeInteraction(member, shop, custom_id))
+        return started, time.perf_counter() - started
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[confirm(FakeMember(guild)) for _ in range(buyers)])
+    report_latencies("drop: confirm acknowledged", [latency for _, latency in results],
+                     time.perf_counter() - started, rss_before)
+
+    await calliope.ticket_queue.join()
+    elapsed = time.perf_counter() - started
+    for worker in workers:
+        worker.cancel()
+    assert len(guild.ticket_channels) == stock, f"{len(guild.ticket_channels)} tickets for {stock} units"
+    assert calliope.available_stock(state, "Limited Drop") == 0
+    ready = [channel.sent[-1][0] - started for channel in guild.ticket_channels]
+    report_latencies("drop: ticket ready", ready, elapsed, rss_before)
+
+
+async def bench_warranties(flows=300):
+    # Moderators sending /warranty for many orders at once; returns the guild for the vouch flood
+    guild = FakeGuild()
+    state = calliope.get_guild_state(guild.id)
+    state.stock_store.set("Warranty Item", flows)
+    staff = FakeMember(guild, roles=[guild.moderator_role])
+    orders_channel = FakeChannel(guild, "orders")
+    buyers = [FakeMember(guild) for _ in range(flows)]
+    rss_before = calliope.resident_memory()
+
+    async def flow(buyer):
+        started = time.perf_counter()
+        await calliope.send_warranty(FakeContext(staff, orders_channel), buyer, "Warranty Item", "1", "")
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*[flow(buyer) for buyer in buyers])
+    report_latencies("/warranty flows", latencies, time.perf_counter() - started, rss_before)
+    assert all(buyer.direct_messages for buyer in buyers)
+    assert state.stocks_data["Warranty Item"] == 0
+    return guild, orders_channel, buyers
+
+
+async def bench_vouch_flood(guild, orders_channel, buyers, noise=5000):
+    # Buyers post their vouch images among a flood of chatter, then moderators lock every order
+    codes = {record['user_id']: code for code, record in calliope.warranty_store.data.items()
+             if record['guild_id'] == guild.id}
+    chatter = [FakeMember(guild) for _ in range(50)]
+    messages = [FakeMessage(guild.vouch_channel, "nice", author=random.choice(chatter)) for _ in range(noise)]
+    for buyer in buyers:
+        messages.append(FakeMessage(guild.vouch_channel, "vouch", author=buyer,
+                                    attachments=[FakeAttachment("proof.png", buyer.id)]))
+    random.shuffle(messages)
+    rss_before = calliope.resident_memory()
+
+    posted = {}
+    started = time.perf_counter()
+    for message in messages:
+        if message.attachments:
+            posted[codes[message.author.id]] = time.perf_counter()
+        await calliope.on_message(message)
+    report("vouch channel dispatch", len(messages), time.perf_counter() - started)
+
+    def notifications():
+        return [(sent_at, message) for sent_at, message in orders_channel.sent
+                if message.embed is not None and message.embed.title == "Vouch Notification"]
+
+    await wait_until(lambda: len(notifications()) == len(buyers))
+    report_latencies("vouch -> notification", [sent_at - posted[reference_code_of(message.embed)]
+                                                for sent_at, message in notifications()],
+                     time.perf_counter() - started, rss_before)
+
+    moderator = FakeMember(guild, roles=[guild.moderator_role])
+    reacted = {}
+    started = time.perf_counter()
+    for _, message in notifications():
+        reacted[reference_code_of(message.embed)] = time.perf_counter()
+        await calliope.on_raw_reaction_add(types.SimpleNamespace(
+            emoji="🔒", user_id=moderator.id, member=moderator, message_id=message.id, guild_id=guild.id))
+
+    def activations():
+        return [(edited_at, embed) for edited_at, embed in orders_channel.edits
+                if embed is not None and embed.title == "Warranty Activated"]
+
+    await wait_until(lambda: len(activations()) == len(buyers))
+    report_latencies("lock -> warranty activated", [edited_at - reacted[reference_code_of(embed)]
+                                                     for edited_at, embed in activations()],
+                     time.perf_counter() - started, rss_before)
+    assert not any(record['guild_id'] == guild.id for record in calliope.warranty_store.data.values())
+
+
+async def bench_bulk_warranty(orders=30):
+    # One /warranty_bulk upload with more orders than stock and a few buyers whose DMs are closed
+    guild = FakeGuild()
+    state = calliope.get_guild_state(guild.id)
+    stock = orders - orders // 10
+    state.stock_store.set("Bulk Item", stock)
+    staff = FakeMember(guild, roles=[guild.moderator_role])
+    orders_channel = FakeChannel(guild, "orders")
+    buyers = [FakeMember(guild) for _ in range(orders)]
+    closed = buyers[::7]
+
+    async def refuse(content=None, **kwargs):
+        await rest.call()
+        raise discord.Forbidden(types.SimpleNamespace(status=403, reason="Forbidden"), "Cannot send messages")
+
+    for buyer in closed:
+        buyer.send = refuse
+    calliope.bot.get_user = guild.members.get
+    text = "user,item,quantity,links\n" + "".join(f"<@{buyer.id}>,Bulk Item,1,https://example.com/{buyer.id}\n"
+                                                     for buyer in buyers)
+
+    started = time.perf_counter()
+    await calliope.send_bulk_warranty(FakeInteraction(staff, orders_channel, "bulk"), text)
+    elapsed = time.perf_counter() - started
+    report("bulk warranty order", orders, elapsed)
+    delivered = sum(1 for buyer in buyers if buyer.direct_messages)
+    assert delivered == stock - sum(1 for buyer in closed if buyers.index(buyer) < stock)
+    assert state.stocks_data["Bulk Item"] == stock - delivered
+    assert len(orders_channel.sent) == 1
+
+
+async def bench_ticket_sweep(dead=200, live=20):
+    # A restart after days offline: a category full of expired tickets, half of them without a record,
+    # next to a few live ones that need their 🗑️ wait back
+    guild = FakeGuild()
+    two_days_ago = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=2)
+    live_channels = []
+    for number in range(dead + live):
+        buyer = FakeMember(guild)
+        channel = await guild.create_text_channel(f"{buyer.name}-item-ticket", {buyer: None}, guild.category)
+        welcome = await channel.send(embed=discord.Embed(title="Welcome to your ticket!"))
+        for _ in range(20):
+            await channel.send(f"message from {buyer.name}")
+        if number >= dead:
+            live_channels.append(channel)
+        else:
+            channel.created_at = two_days_ago
+        if number % 2 == 0:
+            created_at = channel.created_at.timestamp()
+            calliope.ticket_store.set(str(channel.id), {
+                'guild_id': guild.id, 'user_id': buyer.id, 'item': "Item", 'message_id': welcome.id,
+                'reservation_id': None, 'created_at': created_at, 'deadline': created_at + calliope.TICKET_TIMEOUT})
+    calliope.SWEEP_PAUSE = 0  # The fake REST latency stands in for the rate limits
+
+    started = time.perf_counter()
+    await calliope.sweep_tickets()
+    report("ticket sweep (expired tickets closed)", dead, time.perf_counter() - started)
+    assert guild.category.text_channels == live_channels
+    assert all(str(channel.id) in calliope.ticket_waits for channel in live_channels)
+    assert all(calliope.ticket_store.data[str(channel.id)]['user_id'] is not None for channel in live_channels)
+    assert len(os.listdir(os.path.join(calliope.TRANSCRIPT_DIRECTORY, str(guild.id)))) == dead
+
+
+async def bench_vouch_index(hashes=100000, lookups=10000):
+    # Looking up a vouch image among every earlier one, with some lookups a few bits off a stored hash
+    index = calliope.HashIndex()
+    stored = [random.getrandbits(64) for _ in range(hashes)]
+    for key, value in enumerate(stored):
+        index.add(key, value)
+    queries = []
+    for _ in range(lookups):
+        key = random.randrange(hashes)
+        value = stored[key]
+        for bit in random.sample(range(64), random.randint(0, calliope.HASH_DISTANCE)):
+            value ^= 1 << bit
+        queries.append((key, value))
+    started = time.perf_counter()
+    found = sum(any(match == key for _, match in index.near(value)) for key, value in queries)
+    report(f"vouch image lookup ({hashes:,} hashes)", lookups, time.perf_counter() - started)
+    assert found == lookups
+
+
+async def bench_reservations(confirmers=500, stock=100, rounds=20):
+    # Hundreds of buyers pressing Confirm on the same item at once must never oversell it
+    state = calliope.get_guild_state(1)
+    elapsed = 0
+    for round_number in range(rounds):
+        item = f"Drop {round_number}"
+        state.stock_store.set(item, stock)
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *[calliope.reserve_stock(state, item, 1, user_id) for user_id in range(confirmers)]
+        )
+        elapsed += time.perf_counter() - started
+        granted = sum(result is not None for result in results)
+        assert granted == stock, f"{granted} reservations granted for {stock} units"
+        assert calliope.available_stock(state, item) == 0
+    report("reserve_stock (concurrent confirmers)", confirmers * rounds, elapsed)
+
+    started = time.perf_counter()
+    for _ in range(100000):
+        calliope.available_stock(state, "Drop 0")
+    report("available_stock", 100000, time.perf_counter() - started)
+
+
+async def bench_shared_decrements(processes=4, buyers=200, stock=100):
+    # Several shard processes decrementing the same item in the shared SQLite store must never oversell it
+    backend = calliope.SqliteBackend('bench-state.db')
+    stores = [calliope.SqliteBackend('bench-state.db').open('stock', lambda key, value: None)
+              for _ in range(processes)]
+    backend.write('stock', [["set", "Drop", stock]])
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *[stores[buyer % processes].adjust("Drop", -1, 0) for buyer in range(buyers)]
+    )
+    report("shared store adjust (SQLite)", buyers, time.perf_counter() - started)
+    granted = sum(result is not None for result in results)
+    assert granted == stock, f"{granted} decrements granted for {stock} units"
+    assert backend.load('stock')[0][2] == 0
+
+
+async def legacy_reference_code(length=10):
+    # The implementation before the reference code service: one thread-pool hop per character
+    characters = string.ascii_uppercase + string.digits
+    return ''.join(await asyncio.gather(
+        *[asyncio.to_thread(random.choice, characters) for _ in range(length)]
+    ))
+
+
+async def bench_reference_codes(count=100000, legacy_count=2000):
+    started = time.perf_counter()
+    codes = {calliope.generate_reference_code() for _ in range(count)}
+    report("generate_reference_code", count, time.perf_counter() - started)
+    assert len(codes) == count
+
+    started = time.perf_counter()
+    for _ in range(legacy_count):
+        await legacy_reference_code()
+    report("legacy to_thread reference code", legacy_count, time.perf_counter() - started)
+
+
+async def main(arguments):
+    rest.latency = arguments.latency
+    rest.rate_limit_every = arguments.rate_limit_every
+    rest.retry_after = arguments.retry_after
+    install_fakes()
+    writer = asyncio.create_task(calliope.store_writer())
+
+    if not arguments.workloads_only:
+        await bench_reservations()
+        await bench_shared_decrements()
+        await bench_reference_codes()
+        await bench_vouch_index()
+
+    print(f"\nWorkloads with {rest.latency * 1000:g} ms REST latency"
+          + (f", a 429 every {rest.rate_limit_every} calls" if rest.rate_limit_every else ""))
+    await bench_drop(arguments.buyers, arguments.stock)
+    guild, orders_channel, buyers = await bench_warranties(arguments.warranties)
+    await bench_vouch_flood(guild, orders_channel, buyers, arguments.noise)
+    await bench_bulk_warranty(arguments.bulk)
+    await bench_ticket_sweep()
+    print(f"{rest.calls} REST calls, {rest.rate_limited} answered with 429, "
+          f"{calliope.resident_memory() / 2 ** 20:.1f} MiB resident")
+    writer.cancel()
+    calliope.flush_all_stores()
+    if calliope.hash_pool is not None:
+        calliope.hash_pool.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmarks for calliope.py against a fake Discord.")
+    parser.add_argument('--latency', type=float, default=0.005, help="Seconds every fake REST call takes")
+    parser.add_argument('--rate-limit-every', type=int, default=0, help="Answer every Nth REST call with a 429")
+    parser.add_argument('--retry-after', type=float, default=0.05, help="Retry-After of the fake 429s")
+    parser.add_argument('--buyers', type=int, default=500)
+    parser.add_argument('--stock', type=int, default=100)
+    parser.add_argument('--warranties', type=int, default=300)
+    parser.add_argument('--bulk', type=int, default=30, help="Orders in the /warranty_bulk upload")
+    parser.add_argument('--noise', type=int, default=5000, help="Chat messages in the vouch channel flood")
+    parser.add_argument('--workloads-only', action='store_true', help="Skip the micro-benchmarks")
+    asyncio.run(main(parser.parse_args()))
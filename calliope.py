@@ -1,31 +1,455 @@
+import time
+
+STARTED = time.perf_counter()  # The import phase of the startup report is measured from here
+
+import aiohttp
 import asyncio
+import bisect
+import concurrent.futures
+import csv
 import datetime
-import random
+import gzip
+import hashlib
+import heapq
+import io
+import resource
+import secrets
+import sqlite3
 import string
-import aiofiles
+import threading
+import weakref
 import discord
 import pytz as pytz
 import json
+import logging
+import math
+import os
 from discord.ext import commands
-from dotenv import dotenv_values
+from dotenv import dotenv_values, set_key
 from collections import OrderedDict
 from discord.ext.commands import check
 
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix='/', intents=intents)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # Pillow is optional, without it vouch images are not checked for reuse
+
+# Configuration
+
+class Config:
+    # .env keys and the attribute each one is cached under
+    FIELDS = {
+        'VOUCH_CHANNEL': 'vouch_channel',
+        'DUE': 'due',
+        'CATEGORY': 'category',
+        'MODERATOR': 'moderator',
+        'GUILD': 'guild',
+    }
+
+    def __init__(self, env_file):
+        self.env_file = env_file
+        self.token = None
+        self.vouch_channel = None
+        self.due = 0
+        self.category = None
+        self.moderator = None
+        self.guild = None  # The guild that owns the data files from before multi-guild support
+        self.mtime = None
+        values = dotenv_values(env_file)
+        self.update(values)
+
+        # Deployment settings, only read at startup
+        self.shard_count = int(values['SHARD_COUNT']) if values.get('SHARD_COUNT') else None
+        self.shard_ids = parse_shard_ids(values.get('SHARD_IDS'))
+        self.state_backend = values.get('STATE_BACKEND') or 'files'
+        self.state_database = values.get('STATE_DATABASE') or 'state.db'
+        self.profile = values.get('PROFILE') or 'full'
+        self.metrics_port = int(values['METRICS_PORT']) if values.get('METRICS_PORT') else None
+        self.metrics = values.get('METRICS', '').lower() in ('1', 'true', 'yes') or self.metrics_port is not None
+
+    def update(self, values):
+        self.token = values.get('TOKEN', self.token)
+        for variable_name, attribute in self.FIELDS.items():
+            if values.get(variable_name):
+                setattr(self, attribute, int(values[variable_name]))
+        self.mtime = self.stat()
+
+    def stat(self):
+        try:
+            return os.stat(self.env_file).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+
+def parse_shard_ids(text):
+    # "0-3,8" -> [0, 1, 2, 3, 8]
+    if not text:
+        return None
+    shard_ids = []
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        shard_ids.extend(range(int(first), int(last or first) + 1))
+    return shard_ids
+
+
+CONFIG_POLL_INTERVAL = 5  # Seconds between checks of the .env modification time
+
+
+async def config_watcher():
+    # Pick up edits made to .env outside the bot
+    while True:
+        await asyncio.sleep(CONFIG_POLL_INTERVAL)
+        if config.stat() != config.mtime:
+            try:
+                config.update(await in_thread(dotenv_values, config.env_file))
+            except ValueError as e:
+                print(f"Ignoring invalid value in {config.env_file}: {e}")
+                config.mtime = config.stat()
+
 
 # Global Variables
-env_vars = dotenv_values('.env')
-TOKEN = env_vars['TOKEN']
+config = Config('.env')
+TOKEN = config.token
+
+# Gateway events each feature of the bot listens to
+FEATURE_INTENTS = {
+    'commands': {'guilds'},  # Channels and roles for slash commands, tickets and settings
+    'tickets': {'guild_reactions'},  # 🗑️ on the ticket message
+    'vouches': {'guild_messages', 'message_content'},  # Images posted in the vouch channel
+    'notifications': {'guild_reactions'},  # 🔒 on the vouch notification
+}
+LEAN_MESSAGE_CACHE = 100  # Messages kept in the lean profile; every wait runs on raw events or REST
+
+
+def lean_intents(features=FEATURE_INTENTS):
+    intents = discord.Intents.none()
+    for flags in features.values():
+        for flag in flags:
+            setattr(intents, flag, True)
+    return intents
+
+
+if config.profile == 'lean':
+    # Only the events the features need, no member chunking or member cache; members are fetched on demand
+    client_options = {
+        'intents': lean_intents(),
+        'member_cache_flags': discord.MemberCacheFlags.none(),
+        'chunk_guilds_at_startup': False,
+        'max_messages': LEAN_MESSAGE_CACHE,
+    }
+else:
+    client_options = {'intents': discord.Intents.all()}
+# Commands are synced by on_connect below, and only when they changed since the last sync
+client_options['auto_sync_commands'] = False
+if config.shard_count or config.shard_ids:
+    # All shards in this process, or only SHARD_IDS of SHARD_COUNT when the guilds are split over processes
+    bot = commands.AutoShardedBot(command_prefix='/', shard_count=config.shard_count, shard_ids=config.shard_ids,
+                                  **client_options)
+else:
+    bot = commands.Bot(command_prefix='/', **client_options)
 directory = 'stocks_data.json'
+WAL_FLUSH_INTERVAL = 0.5  # Seconds to gather mutations before one write + fsync
+SNAPSHOT_EVERY = 500  # Log entries between two snapshots
+
+
+store_writer_task = None
 
 
 @bot.event
 async def on_ready():
+    global store_writer_task
+    if store_writer_task is None:
+        if config.guild is None and os.path.exists(directory) and not adopt_legacy_guild():
+            await bot.close()
+            return
+        if config.guild is not None:
+            migrate_payment_methods(get_guild_state(config.guild))
+        store_writer_task = asyncio.create_task(store_writer())
+        asyncio.create_task(config_watcher())
+        asyncio.create_task(ticket_sweeper())
+        asyncio.create_task(start_deadlines())
+        for _ in range(TICKET_WORKERS):
+            asyncio.create_task(ticket_worker())
+        asyncio.create_task(board_updater())
+        if config.metrics:
+            await start_instrumentation()
+    if 'ready' not in startup_timings:
+        mark_startup('ready')
+        print(startup_report())
     print(f"Bot is ready. Connected to {len(bot.guilds)} guilds.")
+    print(memory_report())
     await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name='/stocks'))
 
 
+# Startup Timing
+
+startup_timings = {}  # phase -> seconds since the previous phase ended
+startup_last = [STARTED]
+
+
+def mark_startup(phase):
+    now = time.perf_counter()
+    startup_timings[phase] = now - startup_last[0]
+    startup_last[0] = now
+
+
+def startup_report():
+    return "Startup: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup_timings.items())
+
+
+# Command Sync
+# Syncing asks Discord for every global command on each boot and can run into the command rate limit on
+# frequent redeploys. The hash of the command tree and the ids Discord gave the commands are kept in
+# COMMAND_SYNC_FILE; when the tree is unchanged the ids are reused and Discord is not asked at all.
+
+COMMAND_SYNC_FILE = 'commands.json'
+
+
+def command_tree_hash():
+    tree = sorted(json.dumps(command.to_dict(), sort_keys=True) for command in bot.pending_application_commands)
+    return hashlib.blake2b(json.dumps([bot.user.id, tree]).encode()).hexdigest()
+
+
+def restore_command_ids(tree_hash):
+    try:
+        saved = openJson(COMMAND_SYNC_FILE)
+    except (OSError, ValueError):
+        return False
+    ids = saved.get('ids', {})
+    if saved.get('hash') != tree_hash or any(command.name not in ids for command in bot.pending_application_commands):
+        return False
+    for command in bot.pending_application_commands:
+        command.id = ids[command.name]
+        bot._application_commands[command.id] = command  # What sync_commands would have filled in
+    return True
+
+
+async def sync_command_tree(tree_hash):
+    await bot.sync_commands()
+    saveJson({'hash': tree_hash, 'ids': {command.name: command.id for command in bot.pending_application_commands
+                                         if command.id is not None}}, COMMAND_SYNC_FILE)
+
+
+@bot.event
+async def on_connect():
+    if 'sync' in startup_timings:
+        return  # A reconnect, the commands are already known
+    mark_startup('login')
+    tree_hash = command_tree_hash()
+    if restore_command_ids(tree_hash):
+        print("Slash commands unchanged, skipping the sync.")
+    else:
+        await sync_command_tree(tree_hash)
+    mark_startup('sync')
+
+
+@bot.listen()
+async def on_unknown_application_command(interaction):
+    # The saved ids are stale (the commands were changed or removed elsewhere), sync for real next time
+    if os.path.exists(COMMAND_SYNC_FILE):
+        os.remove(COMMAND_SYNC_FILE)
+        await sync_command_tree(command_tree_hash())
+
+
+def resident_memory():
+    # Current resident set size in bytes, or the peak where /proc is not available
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def memory_report():
+    return (
+        f"Profile {config.profile}: {resident_memory() / 2 ** 20:.1f} MiB resident, "
+        f"{sum(len(guild.members) for guild in bot.guilds)} cached members, {len(bot.users)} users, "
+        f"{len(bot.cached_messages)} messages, {len(member_cache)} fetched members, "
+        f"{len(guild_states)} guild states loaded"
+    )
+
+
+# Instrumentation
+# Latency histograms for commands, components, gateway events, disk writes and worker threads, plus
+# event-loop lag, pending waits and 429 counts. Shown by /diag and, with METRICS_PORT, served in the
+# Prometheus text format on localhost. With METRICS off nothing is recorded and no listener is added.
+
+LOOP_LAG_INTERVAL = 0.5  # Seconds between two event-loop lag samples
+METRIC_LABELS = {'command': 'command', 'component': 'action', 'event': 'event', 'disk': 'store', 'thread': 'function'}
+
+
+class Histogram:
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS + (math.inf,), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+
+histograms = {}  # (metric, label) -> Histogram
+counters = {}  # (metric, label) -> count
+threads_in_flight = [0]
+
+
+def observe(metric, label, seconds):
+    if not config.metrics:
+        return
+    histogram = histograms.get((metric, label))
+    if histogram is None:
+        histogram = histograms[(metric, label)] = Histogram()
+    histogram.observe(seconds)
+
+
+def count(metric, label):
+    counters[(metric, label)] = counters.get((metric, label), 0) + 1
+
+
+async def in_thread(func, *args):
+    # asyncio.to_thread, counted and timed per function
+    threads_in_flight[0] += 1
+    started = time.perf_counter()
+    try:
+        return await asyncio.to_thread(func, *args)
+    finally:
+        threads_in_flight[0] -= 1
+        observe('thread', func.__qualname__, time.perf_counter() - started)
+
+
+class RateLimitCounter(logging.Handler):
+    # discord.http only reports a 429 through its log, so count the warnings it emits
+    def emit(self, record):
+        message = str(record.msg)
+        if message.startswith("We are being rate limited"):
+            count('rate_limited', 'route')
+        elif message.startswith("Global rate limit"):
+            count('rate_limited', 'global')
+
+
+logging.getLogger('discord.http').addHandler(RateLimitCounter(logging.WARNING))
+
+command_started = {}  # interaction id -> start of the command
+
+
+async def on_command_started(ctx):
+    command_started[ctx.interaction.id] = time.perf_counter()
+
+
+async def on_command_finished(ctx, error=None):
+    started = command_started.pop(ctx.interaction.id, None)
+    if started is not None:
+        observe('command', ctx.command.qualified_name, time.perf_counter() - started)
+
+
+if config.metrics:
+    bot.add_listener(on_command_started, 'on_application_command')
+    bot.add_listener(on_command_finished, 'on_application_command_completion')
+    bot.add_listener(on_command_finished, 'on_application_command_error')
+
+
+async def sample_loop_lag():
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        observe('loop_lag', None, max(time.perf_counter() - started - LOOP_LAG_INTERVAL, 0))
+
+
+def gauges():
+    return {
+        'tasks': len(asyncio.all_tasks()),
+        'gateway_waits': sum(waits.counts().values()),
+        'wait_for_listeners': sum(len(listeners) for listeners in bot._listeners.values()),
+        'threads_in_flight': threads_in_flight[0],
+        'ticket_queue': ticket_queue.qsize(),
+        'guild_states': len(guild_states),
+        'resident_bytes': resident_memory(),
+    }
+
+
+def prometheus_text():
+    lines = []
+    for name, value in gauges().items():
+        lines.append(f"# TYPE calliope_{name} gauge")
+        lines.append(f"calliope_{name} {value}")
+    for (metric, label), value in sorted(counters.items()):
+        lines.append(f'calliope_{metric}_total{{scope="{label}"}} {value}')
+    for (metric, label), histogram in sorted(histograms.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+        labels = f'{METRIC_LABELS[metric]}="{label}",' if label is not None else ''
+        seen = 0
+        for bound, bucket_count in zip(histogram.BUCKETS + ('+Inf',), histogram.counts):
+            seen += bucket_count
+            lines.append(f'calliope_{metric}_seconds_bucket{{{labels}le="{bound}"}} {seen}')
+        labels = labels.rstrip(',')
+        lines.append(f"calliope_{metric}_seconds_sum{{{labels}}} {histogram.total}")
+        lines.append(f"calliope_{metric}_seconds_count{{{labels}}} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(reader, writer):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = prometheus_text().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_instrumentation():
+    asyncio.create_task(sample_loop_lag())
+    if config.metrics_port is not None:
+        await asyncio.start_server(serve_metrics, '127.0.0.1', config.metrics_port)
+        print(f"Serving metrics on http://127.0.0.1:{config.metrics_port}/metrics")
+
+
+def format_latency(histogram):
+    return f"p50 {histogram.quantile(0.5) * 1000:g} ms, p99 {histogram.quantile(0.99) * 1000:g} ms, n={histogram.count}"
+
+
+# Members fetched on demand, for the lean profile where the gateway does not send member lists
+MEMBER_TTL = 300  # Seconds a fetched member is trusted, role changes show up after at most this long
+MEMBER_CACHE_SIZE = 1024
+member_cache = OrderedDict()  # (guild id, user id) -> (fetched at, member)
+
+
+async def fetch_member(guild, user_id):
+    member = guild.get_member(user_id)
+    if member is not None:
+        return member
+    key = (guild.id, user_id)
+    cached = member_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < MEMBER_TTL:
+        member_cache.move_to_end(key)
+        return cached[1]
+    try:
+        member = await guild.fetch_member(user_id)
+    except discord.NotFound:
+        member = None
+    member_cache[key] = (time.monotonic(), member)
+    member_cache.move_to_end(key)
+    if len(member_cache) > MEMBER_CACHE_SIZE:
+        member_cache.popitem(last=False)
+    return member
+
+
 def openJson(file_path):
     with open(file_path, "r") as file:
         json_data = file.read()
@@ -34,8 +458,353 @@ def openJson(file_path):
 
 
 def saveJson(data_dict, file_path):
-    with open(file_path, "w") as file:
+    # Write next to the old file and rename over it, so a crash mid-write never leaves an empty file
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, "w") as file:
         json.dump(data_dict, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, file_path)
+
+
+# Persistence
+
+dirty_stores = set()
+store_flush_event = asyncio.Event()
+
+
+class Store:
+    # A dict whose mutations are persisted by the backend that opened it.
+    # Values are replaced, never mutated in place, because snapshots are serialized off the event loop.
+    def __init__(self, guild_of=None):
+        self.data = {}
+        self.guild_of = guild_of  # (key, value) -> id of the guild the entry belongs to, if any
+        self.pending = []
+        self.version = 0  # Bumped on every mutation, used to invalidate caches derived from the data
+        self.listeners = []  # Called with ("set" | "pop", key) after every mutation
+        self.owner = None  # Kept alive with the store, so it stays loaded until pending writes are flushed
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.log(["set", key, value] if self.guild_of is None else ["set", key, value, self.guild_of(key, value)])
+        self.notify("set", key)
+
+    def pop(self, key):
+        value = self.data.pop(key)
+        self.log(["pop", key])
+        self.notify("pop", key)
+        return value
+
+    def log(self, entry):
+        self.pending.append(entry)
+        dirty_stores.add(self)
+        store_flush_event.set()
+
+    def notify(self, action, key):
+        self.version += 1
+        for listener in self.listeners:
+            listener(action, key)
+
+    async def adjust(self, key, delta, floor=None):
+        # Add delta to a number unless that takes it below floor; returns the new number, or None if refused
+        return (await self.adjust_many({key: (delta, floor)}))[key]
+
+    async def adjust_many(self, changes):
+        # Several adjustments persisted together: {key: (delta, floor)} -> {key: new number, or None if refused}
+        results = {}
+        for key, (delta, floor) in changes.items():
+            if key not in self.data or (floor is not None and int(self.data[key]) + delta < floor):
+                results[key] = None
+            else:
+                self.set(key, int(self.data[key]) + delta)
+                results[key] = self.data[key]
+        return results
+
+
+class WalStore(Store):
+    # A dict persisted as a snapshot plus an append-only log of mutations.
+    def __init__(self, file_path):
+        super().__init__()
+        self.file_path = file_path
+        self.wal_path = f"{file_path}.wal"
+        if os.path.exists(file_path):
+            # Plain dicts keep insertion order and load several times faster than OrderedDict
+            with open(file_path, "r") as file:
+                self.data = json.load(file)
+        self.wal_entries = 0
+        self.needs_snapshot = False
+
+        # Rebuild the latest state from the log tail
+        if os.path.exists(self.wal_path):
+            with open(self.wal_path, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # Torn write at the end of the log
+                    self.apply(entry)
+                    self.wal_entries += 1
+            # Compact on the first flush so later appends never land after a torn line
+            self.needs_snapshot = self.wal_entries > 0
+
+    def apply(self, entry):
+        if entry[0] == "set":
+            self.data[entry[1]] = entry[2]
+        else:
+            self.data.pop(entry[1], None)
+
+    def take_batch(self):
+        batch, self.pending = self.pending, []
+        snapshot = None
+        if self.needs_snapshot or self.wal_entries + len(batch) >= SNAPSHOT_EVERY:
+            # The snapshot already contains every pending entry
+            snapshot = dict(self.data)
+            batch = []
+            self.wal_entries = 0
+            self.needs_snapshot = False
+        else:
+            self.wal_entries += len(batch)
+        return batch, snapshot
+
+    def write(self, batch, snapshot):
+        if snapshot is not None:
+            saveJson(snapshot, self.file_path)
+            with open(self.wal_path, "w"):
+                pass
+        if batch:
+            with open(self.wal_path, "a") as file:
+                file.write("".join(json.dumps(entry) + "\n" for entry in batch))
+                file.flush()
+                os.fsync(file.fileno())
+
+    async def flush(self):
+        batch, snapshot = self.take_batch()
+        try:
+            await in_thread(self.write, batch, snapshot)
+        except Exception:
+            self.restore_batch(batch)
+            raise
+
+    def flush_now(self):
+        batch, snapshot = self.take_batch()
+        try:
+            self.write(batch, snapshot)
+        except Exception:
+            self.restore_batch(batch)
+            raise
+
+    def restore_batch(self, batch):
+        # The log may end in a torn line now, so the retry rewrites the snapshot, which holds every entry
+        self.pending[:0] = batch
+        self.needs_snapshot = True
+
+
+class SharedStore(Store):
+    # One namespace of a backend shared by every shard process. Entries tagged with a guild are only
+    # loaded by the process running that guild's shard, so each record has exactly one owner.
+    def __init__(self, backend, namespace, guild_of=None, rows=None):
+        super().__init__(guild_of)
+        self.backend = backend
+        self.file_path = namespace
+        self.write_lock = asyncio.Lock()  # Keeps flushes and adjustments of this store in order
+        for key, guild_id, value in backend.load(namespace) if rows is None else rows:
+            if owns_guild(guild_id):
+                self.data[key] = value
+
+    async def flush(self):
+        async with self.write_lock:
+            batch, self.pending = self.pending, []
+            try:
+                await in_thread(self.backend.write, self.file_path, batch)
+            except Exception:
+                self.pending[:0] = batch
+                raise
+
+    def flush_now(self):
+        batch, self.pending = self.pending, []
+        self.backend.write(self.file_path, batch)
+
+    async def adjust_many(self, changes):
+        # Decided by the backend in one transaction, so two shards can never both take the last unit
+        async with self.write_lock:
+            batch, self.pending = self.pending, []
+            try:
+                outcomes = await in_thread(self.backend.adjust, self.file_path, batch, changes)
+            except Exception:
+                self.pending[:0] = batch
+                raise
+        results = {}
+        for key, (applied, value) in outcomes.items():
+            if value is None:
+                if key in self.data:
+                    self.data.pop(key)
+                    self.notify("pop", key)
+            elif self.data.get(key) != value:
+                self.data[key] = value
+                self.notify("set", key)
+            results[key] = value if applied else None
+        return results
+
+
+class FileBackend:
+    # The default: every store is a file next to the bot, for a single process
+    def open(self, namespace, guild_of=None):
+        os.makedirs(os.path.dirname(namespace) or '.', exist_ok=True)
+        return WalStore(namespace)
+
+
+class SharedBackend:
+    # A shared backend only has to implement load, write and adjust for one namespace at a time
+    def open(self, namespace, guild_of=None):
+        rows = self.load(namespace)
+        if not rows and os.path.exists(namespace):
+            # First start on this backend: bring over what the file backend stored
+            rows = [(key, guild_of(key, value) if guild_of else None, value)
+                    for key, value in WalStore(namespace).data.items()]
+            self.write(namespace, [["set", key, value, guild_id] for key, guild_id, value in rows])
+        return SharedStore(self, namespace, guild_of, rows)
+
+
+class SqliteBackend(SharedBackend):
+    # Every shard process on the host opens the same database (WAL mode); SQLite serializes the writers
+    def __init__(self, file_path):
+        self.connection = sqlite3.connect(file_path, check_same_thread=False, timeout=30)
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "namespace TEXT, key TEXT, guild_id INTEGER, value TEXT, PRIMARY KEY (namespace, key))"
+            )
+
+    def load(self, namespace):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key, guild_id, value FROM state WHERE namespace = ?", (namespace,)).fetchall()
+        return [(key, guild_id, json.loads(value)) for key, guild_id, value in rows]
+
+    def apply(self, namespace, batch):
+        for entry in batch:
+            if entry[0] == "set":
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO state (namespace, key, guild_id, value) VALUES (?, ?, ?, ?)",
+                    (namespace, entry[1], entry[3] if len(entry) > 3 else None, json.dumps(entry[2])))
+            else:
+                self.connection.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, entry[1]))
+
+    def write(self, namespace, batch):
+        with self.lock, self.connection:
+            self.apply(namespace, batch)
+
+    def adjust(self, namespace, batch, changes):
+        outcomes = {}
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.apply(namespace, batch)
+            for key, (delta, floor) in changes.items():
+                row = self.connection.execute(
+                    "UPDATE state SET value = CAST(value AS INTEGER) + ? "
+                    "WHERE namespace = ? AND key = ? AND (? IS NULL OR CAST(value AS INTEGER) + ? >= ?) RETURNING value",
+                    (delta, namespace, key, floor, delta, floor)).fetchone()
+                if row is not None:
+                    outcomes[key] = (True, json.loads(row[0]))
+                    continue
+                row = self.connection.execute(
+                    "SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+                outcomes[key] = (False, json.loads(row[0]) if row else None)
+        return outcomes
+
+
+class MemoryBackend(SharedBackend):
+    # In-process stand-in for a shared backend: stores opened from one instance act like shard processes
+    # sharing a database, which is enough to test the bot without SQLite
+    def __init__(self):
+        self.tables = {}  # namespace -> {key: (guild_id, value)}
+        self.lock = threading.Lock()
+
+    def load(self, namespace):
+        with self.lock:
+            return [(key, guild_id, value) for key, (guild_id, value) in self.tables.get(namespace, {}).items()]
+
+    def apply(self, namespace, batch):
+        table = self.tables.setdefault(namespace, {})
+        for entry in batch:
+            if entry[0] == "set":
+                table[entry[1]] = (entry[3] if len(entry) > 3 else None, entry[2])
+            else:
+                table.pop(entry[1], None)
+
+    def write(self, namespace, batch):
+        with self.lock:
+            self.apply(namespace, batch)
+
+    def adjust(self, namespace, batch, changes):
+        outcomes = {}
+        with self.lock:
+            self.apply(namespace, batch)
+            table = self.tables.setdefault(namespace, {})
+            for key, (delta, floor) in changes.items():
+                if key not in table:
+                    outcomes[key] = (False, None)
+                    continue
+                guild_id, value = table[key]
+                if floor is not None and int(value) + delta < floor:
+                    outcomes[key] = (False, value)
+                    continue
+                table[key] = (guild_id, int(value) + delta)
+                outcomes[key] = (True, int(value) + delta)
+        return outcomes
+
+
+def owns_guild(guild_id):
+    # Whether this process runs the shard of a guild; entries without a guild belong to every process
+    if guild_id is None or config.shard_ids is None:
+        return True
+    return (int(guild_id) >> 22) % config.shard_count in config.shard_ids
+
+
+def create_backend():
+    if config.state_backend == 'sqlite':
+        return SqliteBackend(config.state_database)
+    if config.state_backend == 'memory':
+        return MemoryBackend()
+    if config.shard_ids is not None:
+        raise SystemExit("Splitting shards over processes needs STATE_BACKEND=sqlite so they share their state.")
+    return FileBackend()
+
+
+async def store_writer():
+    # Single background writer: coalesces mutations from every store into one fsync per store and interval
+    while True:
+        await store_flush_event.wait()
+        await asyncio.sleep(WAL_FLUSH_INTERVAL)
+        store_flush_event.clear()
+        await flush_dirty_stores()
+
+
+async def flush_dirty_stores():
+    # A function of its own so no reference to a flushed store outlives the pass
+    stores = list(dirty_stores)
+    dirty_stores.clear()
+    for store in stores:
+        started = time.perf_counter()
+        try:
+            await store.flush()
+            observe('disk', store.file_path, time.perf_counter() - started)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Failed to persist {store.file_path}: {e}")
+            dirty_stores.add(store)
+            store_flush_event.set()
+
+
+def flush_all_stores():
+    # Used once the event loop has stopped
+    for store in list(dirty_stores):
+        store.flush_now()
+    dirty_stores.clear()
+
+
+state_backend = create_backend()
 
 
 def convert_seconds_to_hours(seconds):
@@ -43,237 +812,1181 @@ def convert_seconds_to_hours(seconds):
     return f"{hours} HOURS"
 
 
-async def get_vouch_channel_id():
-    env_vars = await asyncio.to_thread(dotenv_values, '.env')
-    return int(env_vars['VOUCH_CHANNEL'])
+REFERENCE_CODE_CHARACTERS = string.ascii_uppercase + string.digits
+reference_code_store = state_backend.open('reference_codes.json')  # every issued code -> issue time
+
+
+def generate_reference_code(length=10):
+    # One draw from the OS CSPRNG, spelled out in base 36, and never handed out twice
+    base = len(REFERENCE_CODE_CHARACTERS)
+    while True:
+        number = secrets.randbelow(base ** length)
+        characters = []
+        for _ in range(length):
+            number, digit = divmod(number, base)
+            characters.append(REFERENCE_CODE_CHARACTERS[digit])
+        code = ''.join(characters)
+        if code not in reference_code_store.data:
+            reference_code_store.set(code, int(time.time()))
+            return code
+
+
+# Scheduler
+
+class Scheduler:
+    # Every deadline in the bot lives in one min-heap backed by a persisted store; a single task sleeps
+    # until the earliest one and fires everything that is due as one batch.
+    def __init__(self, file_path):
+        # "kind:key" -> [kind, key, when, guild id]
+        self.store = state_backend.open(file_path, guild_of=lambda name, entry: entry[3] if len(entry) > 3 else None)
+        self.heap = [(entry[2], name) for name, entry in self.store.data.items()]
+        heapq.heapify(self.heap)
+        self.handlers = {}
+        self.wakeup = asyncio.Event()
+
+    def handler(self, kind):
+        def decorator(func):
+            self.handlers[kind] = func
+            return func
+
+        return decorator
+
+    def schedule(self, kind, key, when, guild_id=None):
+        name = f"{kind}:{key}"
+        if self.store.data.get(name) == [kind, key, when, guild_id]:
+            return
+        self.store.set(name, [kind, key, when, guild_id])
+        heapq.heappush(self.heap, (when, name))
+        if self.heap[0][1] == name:
+            self.wakeup.set()
+
+    def cancel(self, kind, key):
+        # The heap entry is dropped lazily when it reaches the top
+        name = f"{kind}:{key}"
+        if name in self.store.data:
+            self.store.pop(name)
+
+    def upcoming(self, count=10):
+        return heapq.nsmallest(count, ((when, kind, key) for kind, key, when, *_ in self.store.data.values()))
+
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, name = heapq.heappop(self.heap)
+            entry = self.store.data.get(name)
+            if entry is None or entry[2] != when:
+                continue  # Cancelled or rescheduled
+            self.store.pop(name)
+            due.append(entry)
+
+        # Keep memory flat when many deadlines are cancelled before they fire
+        if len(self.heap) > 2 * len(self.store.data) + 64:
+            self.heap = [(entry[2], name) for name, entry in self.store.data.items()]
+            heapq.heapify(self.heap)
+        return due
+
+    async def fire(self, due):
+        results = await asyncio.gather(*[self.handlers[entry[0]](entry[1]) for entry in due], return_exceptions=True)
+        for (kind, key, *_), result in zip(due, results):
+            if isinstance(result, Exception):
+                print(f"Deadline {kind}:{key} failed: {result!r}")
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            due = self.pop_due(now)
+            if due:
+                asyncio.create_task(self.fire(due))
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
 
-async def get_timer_value():
-    env_vars = await asyncio.to_thread(dotenv_values, '.env')
-    return int(env_vars['DUE'])
+scheduler = Scheduler('deadlines.json')
 
 
-async def get_category_id():
-    env_vars = await asyncio.to_thread(dotenv_values, '.env')
-    return int(env_vars['CATEGORY'])
+# Event Dispatcher
 
+class WaitDispatcher:
+    # Pending waits indexed by (kind, key), so each gateway event only runs the checks that could match:
+    # "message" waits are keyed by (channel_id, author_id) and "reaction" waits by message_id.
+    def __init__(self):
+        self.waiters = {}
 
-async def get_moderator_id():
-    env_vars = await asyncio.to_thread(dotenv_values, '.env')
-    return int(env_vars['MODERATOR'])
+    def register(self, kind, key, check, callback):
+        entry = (check, callback)
+        self.waiters.setdefault((kind, key), []).append(entry)
+        return entry
 
+    def unregister(self, kind, key, entry):
+        entries = self.waiters.get((kind, key))
+        if entries and entry in entries:
+            entries.remove(entry)
+            if not entries:
+                del self.waiters[(kind, key)]
 
-async def generate_reference_code(length=10):
-    characters = string.ascii_uppercase + string.digits
-    return ''.join(await asyncio.gather(
-        *[asyncio.to_thread(random.choice, characters) for _ in range(length)]
-    ))
+    def dispatch(self, kind, key, event):
+        for matches, callback in list(self.waiters.get((kind, key), ())):
+            try:
+                if not matches(event):
+                    continue
+                result = callback(event)
+                if asyncio.iscoroutine(result):
+                    asyncio.create_task(result)
+            except Exception as e:
+                print(f"Error while dispatching {kind} event: {e!r}")
 
+    def counts(self):
+        counts = {}
+        for (kind, _), entries in self.waiters.items():
+            counts[kind] = counts.get(kind, 0) + len(entries)
+        return counts
 
-async def replace_env_variable(env_file, variable_name, new_value):
-    # Read the contents of the .env file asynchronously
-    async with aiofiles.open(env_file, 'r') as file:
-        lines = await file.readlines()
 
-    # Find the line that contains the variable
-    for i, line in enumerate(lines):
-        if line.startswith(variable_name + '='):
-            lines[i] = f'{variable_name}={new_value}\n'
-            break
+waits = WaitDispatcher()
+
+
+@bot.listen()
+async def on_message(message):
+    started = time.perf_counter()
+    waits.dispatch("message", (message.channel.id, message.author.id), message)
+    observe('event', 'message', time.perf_counter() - started)
+
 
-    # Write the updated contents back to the .env file asynchronously
-    async with aiofiles.open(env_file, 'w') as file:
-        await file.writelines(lines)
+@bot.listen()
+async def on_raw_reaction_add(payload):
+    started = time.perf_counter()
+    waits.dispatch("reaction", payload.message_id, payload)
+    observe('event', 'reaction', time.perf_counter() - started)
+
+
+# Component Routing
+# Buttons and selects carry their whole state in the custom_id ("<action>:<arguments>"). Views are sent
+# with store=False and one listener decodes the id, so open menus cost no memory and survive restarts.
+# bot.add_view only matches exact custom_ids, which can't cover per-item ids, hence the listener.
+
+component_handlers = {}
+
+
+def component(action):
+    def decorator(func):
+        component_handlers[action] = func
+        return func
+
+    return decorator
+
+
+@bot.listen()
+async def on_interaction(interaction: discord.Interaction):
+    if interaction.type != discord.InteractionType.component:
+        return
+    action, _, arguments = interaction.data.get('custom_id', '').partition(':')
+    handler = component_handlers.get(action)
+    if handler is not None:
+        started = time.perf_counter()
+        await handler(interaction, *arguments.split(':'))
+        observe('component', action, time.perf_counter() - started)
+
+
+def is_staff(member):
+    if member.guild_permissions.administrator:
+        return True
+    return discord.utils.get(member.roles, id=get_guild_state(member.guild.id).config.moderator) is not None
+
+
+async def respond_missing_role(ctx):
+    embed = discord.Embed(
+        title="You need permission to use this command",
+        description="Sorry, but it seems like you don't have the necessary role to use this command.\n"
+                    "If you believe this is a mistake, please contact the Administrator for assistance.",
+        color=0xFF0000
+    )
+    await ctx.respond(embed=embed, ephemeral=True)
 
 
 def has_required_role():
     async def predicate(ctx):
-        if ctx.author.guild_permissions.administrator:
-            return True
-        role = discord.utils.get(ctx.author.roles, id=await get_moderator_id())
-        if role is None:
-            embed = discord.Embed(
-                title="You need permission to use this command",
-                description="Sorry, but it seems like you don't have the necessary role to use this command.\n"
-                            "If you believe this is a mistake, please contact the Administrator for assistance.",
-                color=0xFF0000
-            )
-            await ctx.respond(embed=embed, ephemeral=True)
+        if not is_staff(ctx.author):
+            await respond_missing_role(ctx)
             return False
         return True
 
     return check(predicate)
 
 
-class BuyNow(discord.ui.View):
-    def __init__(self, selected_item, quantity):
-        super().__init__()
-        self.selected_item = selected_item
-        self.quantity = quantity
+# Embed Templates
+# Responses are laid out once and kept as embed dicts; each call only fills in its own fields. Layouts
+# built from guild data are cached per guild and dropped when that data changes.
+
+class TemplateRegistry:
+    def __init__(self):
+        self.builders = {}  # name -> function(scope) returning a discord.Embed with {placeholders}
+        self.compiled = {}  # (name, scope) -> embed dict
+
+    def template(self, name):
+        def decorator(func):
+            self.builders[name] = func
+            return func
+
+        return decorator
+
+    def render(self, name, scope=None, **fields):
+        key = (name, scope)
+        if key not in self.compiled:
+            self.compiled[key] = self.builders[name](scope).to_dict()
+        return discord.Embed.from_dict(fill_template(self.compiled[key], fields))
+
+    def invalidate(self, guild_id):
+        # Scopes are a guild id or a tuple starting with one
+        for key in [key for key in self.compiled
+                    if key[1] == guild_id or (isinstance(key[1], tuple) and key[1][0] == guild_id)]:
+            del self.compiled[key]
+
+
+def fill_template(value, fields):
+    # Copies the cached dict as it goes, so the embed handed out can be changed freely
+    if isinstance(value, str):
+        return value.format_map(fields) if fields and '{' in value else value
+    if isinstance(value, dict):
+        return {key: fill_template(item, fields) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill_template(item, fields) for item in value]
+    return value
+
+
+templates = TemplateRegistry()
+
+
+# Guild State
+# Every storefront guild has its own settings, catalog and reservations under guilds/<guild id>/. A guild's
+# state is loaded on first use and kept in an LRU cache, so memory follows the guilds that are active
+# rather than every guild the bot is in. A state dropped from the cache stays loaded for as long as a
+# coroutine holds it or one of its stores has writes pending, and is handed out again if asked for
+# meanwhile, so there is never a second copy of a guild's files in memory.
+
+GUILDS_DIRECTORY = 'guilds'
+GUILD_CACHE_SIZE = 64  # Guild states kept in memory at once
+
+
+class GuildConfig:
+    # Settings changed with /channel, /moderator, /category and /timer. Anything a guild has not set falls
+    # back to .env: every setting for the guild named by GUILD (or every guild when GUILD is unset), only
+    # the timer for the others, since their channels and roles can't be the ones in .env.
+    def __init__(self, guild_id, file_path):
+        self.guild_id = guild_id
+        self.store = state_backend.open(file_path, guild_of=lambda key, value: guild_id)
+
+    def __getattr__(self, attribute):
+        if attribute not in Config.FIELDS.values() or attribute == 'guild':
+            raise AttributeError(attribute)
+        if attribute in self.store.data:
+            return self.store.data[attribute]
+        if attribute == 'due' or config.guild in (None, self.guild_id):
+            return getattr(config, attribute)
+        return None
+
+    def set(self, attribute, value):
+        self.store.set(attribute, value)
+
+
+def guild_config_path(guild_id):
+    return os.path.join(GUILDS_DIRECTORY, str(guild_id), 'config.json')
+
+
+class GuildState:
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        folder = os.path.join(GUILDS_DIRECTORY, str(guild_id))
+        legacy = guild_id == config.guild
+        self.config = GuildConfig(guild_id, guild_config_path(guild_id))
+        self.stock_store = state_backend.open(directory if legacy else os.path.join(folder, 'stocks_data.json'),
+                                              self.guild_of)
+        self.stocks_data = self.stock_store.data
+        self.reservation_store = state_backend.open(  # reservation id -> reservation record
+            'reservations.json' if legacy else os.path.join(folder, 'reservations.json'), self.guild_of)
+        self.reserved = {}  # item -> reserved quantity
+        self.reservations_by_holder = {}  # (user id, item) -> reservation ids
+        self.item_locks = {}
+        for reservation_id, record in self.reservation_store.data.items():
+            index_reservation(self, reservation_id, record)
+        self.item_names = {item_key(name): name for name in self.stocks_data}
+        self.item_index = ItemIndex(self.stocks_data)
+        self.catalog_cache = {'version': None, 'names': {}, 'pages': {}}
+        self.stock_store.listeners.append(self.update_items)
+        self.stock_store.listeners.append(self.mark_board_dirty)
+        self.reservation_store.listeners.append(self.mark_board_dirty)
+        self.payment_store = state_backend.open(  # payment method name -> {label, account}
+            os.path.join(folder, 'payment_methods.json'), self.guild_of)
+        self.payment_store.listeners.append(self.invalidate_templates)
+        self.analytics_store = state_backend.open(  # "<day>|<verifier id>|<item>" -> units per sale event
+            os.path.join(folder, 'analytics.json'), self.guild_of)
+        self.sales_days = {}  # day -> keys of its analytics counters
+        self.sales_day_order = []  # the days above, sorted
+        for key in self.analytics_store.data:
+            index_sales(self, key)
+        for store in (self.config.store, self.stock_store, self.reservation_store, self.payment_store,
+                      self.analytics_store):
+            store.owner = self
+
+    def guild_of(self, key, value):
+        return self.guild_id
+
+    def update_items(self, action, name):
+        if action == "pop":
+            self.item_names.pop(item_key(name), None)
+            self.item_index.remove(name)
+        else:
+            self.item_names[item_key(name)] = name
+            self.item_index.add(name)
 
-    @discord.ui.button(label="Confirm", style=discord.ButtonStyle.primary)
-    async def confirm_button(self, button, interaction):
+    def invalidate_templates(self, action, key):
+        templates.invalidate(self.guild_id)
 
-        self.disable_all_items()
-        self.clear_items()
-        await interaction.response.edit_message(view=self)
+    def mark_board_dirty(self, action, key):
+        mark_board_dirty(self.guild_id)
 
-        if self.quantity <= 0:
-            await interaction.followup.send(
-                embed=discord.Embed(
-                    title="Out of Stock",
-                    description=f"The selected item `{self.selected_item}` is currently out of stock.",
-                    color=discord.Color.red()
-                ),
-                ephemeral=True
-            )
-            return
 
-        # Create a text-channel and send a welcome message
-        guild = interaction.guild
-        member = interaction.user
+guild_states = OrderedDict()  # guild id -> GuildState, least recently used first
+loaded_guild_states = weakref.WeakValueDictionary()  # guild id -> every GuildState still in memory
 
-        overwrites = {
-            guild.default_role: discord.PermissionOverwrite(read_messages=False),
-            member: discord.PermissionOverwrite(read_messages=True),
-        }
 
-        moderator_roles = [role for role in guild.roles if role.id == await get_moderator_id()]
+def adopt_legacy_guild():
+    # The data files from before multi-guild support belong to GUILD. Without it they can only be the only
+    # guild's, which is then written to .env for good; in several guilds there is no telling whose they are.
+    if len(bot.guilds) != 1 or config.shard_ids is not None:
+        print(f"{directory} is from before multi-guild support. Set GUILD in .env to the guild it belongs to.")
+        return False
+    config.guild = bot.guilds[0].id
+    set_key(config.env_file, 'GUILD', str(config.guild))
+    print(f"{directory} belongs to {bot.guilds[0].name}, saved GUILD={config.guild} to {config.env_file}.")
+    return True
 
-        for role in moderator_roles:
-            overwrites[role] = discord.PermissionOverwrite(read_messages=True)
 
-        ticket_names = f"{member.name}-{self.selected_item}-ticket"
+def get_guild_state(guild_id):
+    state = guild_states.get(guild_id)
+    if state is None:
+        state = loaded_guild_states.get(guild_id)
+        if state is None:
+            state = loaded_guild_states[guild_id] = GuildState(guild_id)
+        guild_states[guild_id] = state
+        while len(guild_states) > GUILD_CACHE_SIZE:
+            guild_states.popitem(last=False)
+    else:
+        guild_states.move_to_end(guild_id)
+    return state
 
-        # Define Category ID
-        category = guild.get_channel(await get_category_id())
 
-        channel = await guild.create_text_channel(ticket_names, overwrites=overwrites, category=category)
-        embed = discord.Embed(
-            title="Welcome to your ticket!",
-            description=f"Hey there {member.mention}! We're here to assist you and make your experience as smooth as possible. Just hang on for a moment, and one of our moderators will be with you shortly.\n\nIf you have any questions or concerns, feel free to let us know. We're here to help!\n\nIf you change your mind and want to delete this ticket, you can simply react with the `🗑️` emoji. This will help us keep things organized and ensure a seamless experience for everyone."
-                        f"\n\n**Order:** `{self.selected_item}`",
-            color=discord.Color.nitro_pink()
-        )
+async def load_guild_state(guild_id):
+    # get_guild_state with the files of a guild that is not in memory read in a worker thread
+    if guild_id not in loaded_guild_states:
+        state = await in_thread(GuildState, guild_id)
+        loaded_guild_states.setdefault(guild_id, state)  # Unless get_guild_state loaded it meanwhile
+    return get_guild_state(guild_id)
 
-        # Handle the confirmation logic here
 
-        await interaction.followup.send(
-            embed=discord.Embed(
-                title="Ticket Created",
-                description=f"You have confirmed to buy `{self.selected_item}`\n"
-                            f"Current Stocks: `{self.quantity}`"
-                            f"\n\n"
-                            f"{channel.mention}",
-                color=discord.Color.green()
-            ),
-            ephemeral=True
+async def load_guild_config(guild_id):
+    # Only the settings of a guild, for background jobs: the rest of an idle guild's state stays on disk
+    state = loaded_guild_states.get(guild_id)
+    if state is not None:
+        return state.config
+    return await in_thread(GuildConfig, guild_id, guild_config_path(guild_id))
+
+
+@bot.check
+async def guild_state_loaded(ctx):
+    # Runs before every command and its checks, so no command reads a guild's files on the event loop
+    if ctx.guild_id is not None:
+        await load_guild_state(ctx.guild_id)
+    return True
+
+
+# Stock Reservations
+# A Confirm reserves the unit until the order is committed by /warranty, the ticket is closed or the
+# reservation expires. Available quantity is the stock minus what is currently reserved.
+
+RESERVATION_TTL = 86400  # Seconds a confirmed purchase holds its stock
+
+
+def index_reservation(state, reservation_id, record, sign=1):
+    item = record['item']
+    state.reserved[item] = state.reserved.get(item, 0) + sign * record['quantity']
+    holder = (record['user_id'], item)
+    if sign > 0:
+        state.reservations_by_holder.setdefault(holder, []).append(reservation_id)
+    else:
+        state.reservations_by_holder[holder].remove(reservation_id)
+        if not state.reservations_by_holder[holder]:
+            del state.reservations_by_holder[holder]
+        if not state.reserved[item]:
+            del state.reserved[item]
+
+
+def item_lock(state, item):
+    if item not in state.item_locks:
+        state.item_locks[item] = asyncio.Lock()
+    return state.item_locks[item]
+
+
+def available_stock(state, item):
+    return max(int(state.stocks_data.get(item, 0)) - state.reserved.get(item, 0), 0)
+
+
+async def reserve_stock(state, item, quantity, user_id):
+    async with item_lock(state, item):
+        if item not in state.stocks_data or available_stock(state, item) < quantity:
+            return None
+        reservation_id = secrets.token_hex(8)
+        hold_stock(state, reservation_id, {'item': item, 'quantity': quantity, 'user_id': user_id,
+                                           'expires': time.time() + RESERVATION_TTL})
+        return reservation_id
+
+
+def hold_stock(state, reservation_id, record):
+    state.reservation_store.set(reservation_id, record)
+    index_reservation(state, reservation_id, record)
+    scheduler.schedule('reservation', f"{state.guild_id}:{reservation_id}", record['expires'], state.guild_id)
+
+
+async def release_stock(state, reservation_id):
+    if reservation_id not in state.reservation_store.data:
+        return None
+    record = state.reservation_store.pop(reservation_id)
+    index_reservation(state, reservation_id, record, -1)
+    scheduler.cancel('reservation', f"{state.guild_id}:{reservation_id}")
+    return record
+
+
+@scheduler.handler('reservation')
+async def expire_reservation(key):
+    guild_id, _, reservation_id = key.rpartition(':')
+    # Reservations scheduled before multi-guild support belong to the legacy guild
+    await release_stock(get_guild_state(int(guild_id) if guild_id else config.guild), reservation_id)
+    scheduler.cancel('reservation', key)
+
+
+def held_reservations(state, item, quantity, user_id, skip=()):
+    # The buyer's reservations an order of quantity uses up, and how many units they hold
+    held, reservation_ids = 0, []
+    for reservation_id in state.reservations_by_holder.get((user_id, item), ()):
+        if held >= quantity:
+            break
+        if reservation_id not in skip:
+            held += state.reservation_store.data[reservation_id]['quantity']
+            reservation_ids.append(reservation_id)
+    return held, reservation_ids
+
+
+async def commit_stock(state, item, quantity, user_id):
+    # Take the stock for an order, counting the buyer's reservations for the item as theirs. The reservations
+    # are only released once the stock is taken, so a refused order keeps its hold. Returns the released
+    # reservations as (id, record), for refund_stock, or None if the order was refused.
+    async with item_lock(state, item):
+        if item not in state.stocks_data:
+            return None
+        held, reservation_ids = held_reservations(state, item, quantity, user_id)
+        if int(state.stocks_data[item]) - state.reserved.get(item, 0) + held < quantity:
+            return None
+        # The store checks and decrements in one step, so the count stays right even across shard processes
+        if await state.stock_store.adjust(item, -quantity, state.reserved.get(item, 0) - held) is None:
+            return None
+        return [(reservation_id, await release_stock(state, reservation_id)) for reservation_id in reservation_ids]
+
+
+async def commit_stock_many(state, orders):
+    # commit_stock for a batch of (item, quantity, user_id): orders are granted in turn while stock lasts,
+    # then every decrement is persisted in one transaction. Returns commit_stock's result for each order.
+    items = sorted({item for item, quantity, user_id in orders})
+    locks = [item_lock(state, item) for item in items]
+    for lock in locks:
+        await lock.acquire()
+    try:
+        room = {item: int(state.stocks_data[item]) - state.reserved.get(item, 0)
+                for item in items if item in state.stocks_data}
+        taken, held_units, consumed = {}, {}, {}  # Per item: units taken, units held, reservation ids used up
+        granted = []  # Per order: the reservation ids it uses up, or None if it does not fit
+        for item, quantity, user_id in orders:
+            held, reservation_ids = held_reservations(state, item, quantity, user_id, consumed.get(item, ()))
+            if item in room and room[item] + held >= quantity:
+                room[item] += held - quantity
+                taken[item] = taken.get(item, 0) + quantity
+                held_units[item] = held_units.get(item, 0) + held
+                consumed.setdefault(item, []).extend(reservation_ids)
+                granted.append(reservation_ids)
+            else:
+                granted.append(None)
+        results = await state.stock_store.adjust_many(
+            {item: (-quantity, state.reserved.get(item, 0) - held_units[item]) for item, quantity in taken.items()})
+        released = []
+        for reservation_ids, (item, quantity, user_id) in zip(granted, orders):
+            # Another shard got to an item first: none of its orders went through
+            if reservation_ids is None or results[item] is None:
+                released.append(None)
+            else:
+                released.append([(reservation_id, await release_stock(state, reservation_id))
+                                 for reservation_id in reservation_ids])
+        return released
+    finally:
+        for lock in locks:
+            lock.release()
+
+
+async def refund_stock(state, quantities, released):
+    # Give back the stock of orders that did not go through ({item: quantity}), with the reservations
+    # commit_stock released for them, so a buyer's held unit cannot be taken by someone else meanwhile
+    locks = [item_lock(state, item) for item in sorted(quantities)]
+    for lock in locks:
+        await lock.acquire()
+    try:
+        results = await state.stock_store.adjust_many({item: (quantity, None) for item, quantity in quantities.items()})
+        for reservation_id, record in released:
+            if record is not None and results.get(record['item']) is not None:
+                hold_stock(state, reservation_id, record)
+    finally:
+        for lock in locks:
+            lock.release()
+
+
+def rename_reservations(state, name, new_name):
+    for reservation_id, record in list(state.reservation_store.data.items()):
+        if record['item'] == name:
+            index_reservation(state, reservation_id, record, -1)
+            record = {**record, 'item': new_name}
+            state.reservation_store.set(reservation_id, record)
+            index_reservation(state, reservation_id, record)
+    if name in state.item_locks:
+        state.item_locks[new_name] = state.item_locks.pop(name)
+
+
+# Ticket State
+
+TICKET_TIMEOUT = 86400  # Seconds before an untouched ticket is closed automatically
+# channel id -> ticket record
+ticket_store = state_backend.open('tickets.json', guild_of=lambda channel_id, record: record['guild_id'])
+ticket_waits = {}  # channel id -> (kind, key, entry) of the 🗑️ wait
+closing_tickets = set()  # channel ids being archived
+
+
+def watch_ticket(channel_id):
+    record = ticket_store.data[channel_id]
+    guild_config = get_guild_state(record['guild_id']).config
+
+    def check(payload):
+        moderator_role = (discord.utils.get(payload.member.roles, id=guild_config.moderator)
+                          if payload.member else None)
+        return (
+                str(payload.emoji) == "🗑️"
+                and payload.user_id != bot.user.id
+                and (payload.user_id == record['user_id'] or moderator_role is not None)
         )
 
-        # Ghost ping the user and mods
-        moderator_role = discord.utils.get(guild.roles, id=await get_moderator_id())
-        ghost_ping = await channel.send(f"{member.mention}, {guild.owner.mention}, {moderator_role.mention}")
-        await ghost_ping.delete()
+    entry = waits.register("reaction", record['message_id'], check, lambda payload: close_ticket(channel_id))
+    ticket_waits[channel_id] = ("reaction", record['message_id'], entry)
 
-        # Send the embedded message and add the reaction
-        message = await channel.send(embed=embed)
 
-        await message.add_reaction("🗑️")
+@scheduler.handler('ticket')
+async def close_ticket(channel_id):
+    if channel_id not in ticket_store.data or channel_id in closing_tickets:
+        return
+    channel = bot.get_channel(int(channel_id))
+    if channel is not None:
+        # The channel is only deleted once its transcript is safely on disk
+        closing_tickets.add(channel_id)
+        try:
+            await archive_ticket(channel, ticket_store.data[channel_id])
+        except (discord.HTTPException, OSError) as e:
+            print(f"Could not archive ticket {channel_id}, retrying later: {e}")
+            scheduler.schedule('ticket', channel_id, time.time() + TRANSCRIPT_RETRY,
+                               ticket_store.data[channel_id]['guild_id'])
+            return
+        finally:
+            closing_tickets.discard(channel_id)
+    if channel_id not in ticket_store.data:
+        return
+    await forget_ticket(channel_id)
+
+    if channel is not None:
+        try:
+            await channel.delete()
+        except discord.NotFound:
+            pass
 
-        def check(reaction, user):
-            return (
-                    str(reaction.emoji) == "🗑️"
-                    and (user == member or moderator_role in user.roles)
-                    and reaction.message.channel == channel
-            )
 
+async def forget_ticket(channel_id):
+    record = ticket_store.pop(channel_id)
+    if record.get('reservation_id'):
+        await release_stock(get_guild_state(record['guild_id']), record['reservation_id'])
+    scheduler.cancel('ticket', channel_id)
+    if channel_id in ticket_waits:
+        waits.unregister(*ticket_waits.pop(channel_id))
+
+
+def rearm_ticket(channel_id):
+    record = ticket_store.data[channel_id]
+    if record['message_id'] is not None and channel_id not in ticket_waits:
+        watch_ticket(channel_id)
+    scheduler.schedule('ticket', channel_id, record['deadline'], record['guild_id'])
+
+
+# Ticket Transcripts
+# A ticket's history is streamed page by page into transcripts/<guild id>/<channel id>.jsonl.gz, one
+# gzip member per chunk of messages, so memory stays flat however long the ticket is. History pages go
+# through the HTTP client's rate limiting, and at most TRANSCRIPT_WORKERS tickets are archived at once.
+# Transcripts are indexed in the order ledger by ticket and buyer, and by reference code through the
+# orders sent in the ticket.
+
+TRANSCRIPT_DIRECTORY = 'transcripts'
+TRANSCRIPT_CHUNK = 200  # Messages per gzip member
+TRANSCRIPT_WORKERS = 2
+TRANSCRIPT_RETRY = 300  # Seconds before a failed archive is tried again
+TRANSCRIPT_UPLOAD_LIMIT = 8 * 2 ** 20  # Bytes attached to one response; the transcripts past it are only listed
+transcript_slots = asyncio.Semaphore(TRANSCRIPT_WORKERS)
+
+
+def transcript_line(message):
+    return json.dumps({
+        'id': message.id,
+        'author_id': message.author.id,
+        'author': str(message.author),
+        'created_at': message.created_at.isoformat(),
+        'content': message.content,
+        'attachments': [{'filename': attachment.filename, 'url': attachment.url}
+                        for attachment in message.attachments],
+        'embeds': [{'title': embed.title, 'description': embed.description} for embed in message.embeds],
+    }) + "\n"
+
+
+def write_transcript_chunk(path, lines, first, last):
+    with open(path, 'wb' if first else 'ab') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as file:
+            file.write("".join(lines).encode())
+        if last:
+            raw.flush()
+            os.fsync(raw.fileno())
+    if last:
+        directory_fd = os.open(os.path.dirname(path), os.O_RDONLY)
         try:
-            reaction, _ = await bot.wait_for("reaction_add", check=check, timeout=86400)
-        except asyncio.TimeoutError:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+
+async def archive_ticket(channel, record):
+    folder = os.path.join(TRANSCRIPT_DIRECTORY, str(record['guild_id']))
+    path = os.path.join(folder, f"{channel.id}.jsonl.gz")
+    async with transcript_slots:
+        os.makedirs(folder, exist_ok=True)
+        lines = []
+        messages = 0
+        first = True
+        async for message in channel.history(limit=None, oldest_first=True):
+            lines.append(transcript_line(message))
+            messages += 1
+            if len(lines) >= TRANSCRIPT_CHUNK:
+                await in_thread(write_transcript_chunk, path, lines, first, False)
+                lines = []
+                first = False
+        await in_thread(write_transcript_chunk, path, lines, first, True)
+    await ledger.add_transcript(channel.id, record, path, messages)
+    return path
+
+
+@bot.slash_command(description="Fetch the archived transcripts of a buyer's tickets or of an order.")
+@has_required_role()
+async def transcript(ctx: commands.Context,
+                     user: discord.Option(discord.User, "The buyer", required=False, default=None),
+                     reference_code: discord.Option(str, "Reference code of the order", required=False,
+                                                    default=None)):
+    if user is None and reference_code is None:
+        await ctx.respond("Please choose a user or a reference code.", ephemeral=True)
+        return
+    rows = await ledger.transcripts(ctx.guild.id, user_id=user.id if user else None,
+                                    reference_code=reference_code.strip().upper() if reference_code else None)
+    if not rows:
+        await ctx.respond("No archived tickets found.", ephemeral=True)
+        return
+    lines = []
+    files = []
+    attached = 0
+    for row in rows:
+        lines.append(f"<#{row['channel_id']}> `{row['item']}` - <@{row['user_id']}> - {row['messages']} messages - "
+                     f"`{format_deadline(row['created_at'])}`")
+        size = os.path.getsize(row['path']) if os.path.exists(row['path']) else None
+        if size is not None and attached + size <= TRANSCRIPT_UPLOAD_LIMIT:
+            files.append(discord.File(row['path']))
+            attached += size
+        else:
+            lines[-1] += f" - `{row['path']}`"
+    embed = discord.Embed(title="Ticket Transcripts", description="\n".join(lines), color=0x3498db)
+    await ctx.respond(embed=embed, files=files, ephemeral=True)
+
+
+# Ticket Sweep
+# On startup and every TICKET_SWEEP_INTERVAL the ticket records are reconciled with the channels in each
+# guild's ticket category. Live tickets get their 🗑️ wait and auto-close back, ticket channels without a
+# record are adopted, and expired tickets are archived and deleted SWEEP_BATCH at a time, so a backlog of
+# dead channels is cleared without running into the channel rate limits.
+
+TICKET_SWEEP_INTERVAL = 3600  # Seconds
+SWEEP_BATCH = 5  # Expired tickets closed at once
+SWEEP_PAUSE = 5  # Seconds between batches
+
+
+async def adopt_ticket(channel):
+    # A ticket channel with no record: created before tickets were persisted, or its record was lost
+    created_at = channel.created_at.timestamp()
+    # The raw overwrites, since channel.overwrites leaves out members that are not cached
+    buyers = [overwrite.id for overwrite in channel._overwrites
+              if overwrite.is_member() and overwrite.id != bot.user.id]
+    record = {
+        'guild_id': channel.guild.id,
+        'user_id': buyers[0] if buyers else None,
+        'item': None,
+        'message_id': None,
+        'reservation_id': None,
+        'created_at': created_at,
+        'deadline': created_at + TICKET_TIMEOUT,
+    }
+    if record['deadline'] > time.time():
+        # Find the welcome message so the 🗑️ reaction works again
+        try:
+            async for message in channel.history(limit=5, oldest_first=True):
+                if message.author.id == bot.user.id and message.embeds \
+                        and message.embeds[0].title == "Welcome to your ticket!":
+                    record['message_id'] = message.id
+                    break
+        except discord.HTTPException:
             pass
+    ticket_store.set(str(channel.id), record)
+    return record
+
+
+async def sweep_tickets():
+    now = time.time()
+    gone, expired = [], []
+    for channel_id, record in list(ticket_store.data.items()):
+        guild = bot.get_guild(record['guild_id'])
+        if channel_id in closing_tickets or guild is None or guild.unavailable:
+            continue  # A guild in an outage or still loading has no channels in the cache yet
+        if bot.get_channel(int(channel_id)) is None:
+            gone.append(channel_id)
+        elif record['deadline'] <= now:
+            scheduler.cancel('ticket', channel_id)  # Closed below with the other expired tickets
+            expired.append(channel_id)
         else:
+            rearm_ticket(channel_id)
+    for channel_id in gone:
+        await forget_ticket(channel_id)
+
+    adopted = 0
+    for guild in bot.guilds:
+        if guild.unavailable:
+            continue
+        category = guild.get_channel((await load_guild_config(guild.id)).category)
+        for channel in list(getattr(category, 'text_channels', ())):
+            channel_id = str(channel.id)
+            if not channel.name.endswith('-ticket') or channel_id in ticket_store.data:
+                continue
+            record = await adopt_ticket(channel)
+            adopted += 1
+            if record['deadline'] <= now:
+                expired.append(channel_id)
+            else:
+                rearm_ticket(channel_id)
+
+    for start in range(0, len(expired), SWEEP_BATCH):
+        if start:
+            await asyncio.sleep(SWEEP_PAUSE)
+        batch = expired[start:start + SWEEP_BATCH]
+        results = await asyncio.gather(*[close_ticket(channel_id) for channel_id in batch], return_exceptions=True)
+        for channel_id, result in zip(batch, results):
+            if isinstance(result, Exception):
+                print(f"Could not close ticket {channel_id}: {result!r}")
+    if gone or adopted or expired:
+        print(f"Ticket sweep: {len(gone)} records without a channel dropped, {adopted} channels adopted, "
+              f"{len(expired)} expired tickets closed.")
+
+
+async def ticket_sweeper():
+    while True:
+        try:
+            await sweep_tickets()
+        except Exception as e:
+            print(f"Ticket sweep failed: {e!r}")
+        await asyncio.sleep(TICKET_SWEEP_INTERVAL)
+
+
+# Ticket Provisioning
+# Confirms are acknowledged immediately and queued. A few workers create the ticket channels, with at
+# most one request in flight per REST route (channel creation per guild, messages per channel), so a
+# burst of purchases is spread over the rate limits instead of piling up behind them.
+
+TICKET_WORKERS = 4
+ticket_queue = asyncio.Queue()
+route_locks = {}
+
+
+async def call_route(route, coroutine):
+    if route not in route_locks:
+        route_locks[route] = asyncio.Lock()
+    async with route_locks[route]:
+        return await coroutine
+
+
+async def provision_ticket(interaction, selected_item, reservation_id, status_message):
+    # Create a text-channel and send a welcome message
+    guild = interaction.guild
+    member = interaction.user
+    state = get_guild_state(guild.id)
+
+    overwrites = {
+        guild.default_role: discord.PermissionOverwrite(read_messages=False),
+        member: discord.PermissionOverwrite(read_messages=True),
+    }
+
+    moderator_roles = [role for role in guild.roles if role.id == state.config.moderator]
+
+    for role in moderator_roles:
+        overwrites[role] = discord.PermissionOverwrite(read_messages=True)
+
+    ticket_names = f"{member.name}-{selected_item}-ticket"
+
+    # Define Category ID
+    category = guild.get_channel(state.config.category)
+
+    channel = await call_route(('channels', guild.id),
+                               guild.create_text_channel(ticket_names, overwrites=overwrites, category=category))
+    embed = discord.Embed(
+        title="Welcome to your ticket!",
+        description=f"Hey there {member.mention}! We're here to assist you and make your experience as smooth as possible. Just hang on for a moment, and one of our moderators will be with you shortly.\n\nIf you have any questions or concerns, feel free to let us know. We're here to help!\n\nIf you change your mind and want to delete this ticket, you can simply react with the `🗑️` emoji. This will help us keep things organized and ensure a seamless experience for everyone."
+                    f"\n\n**Order:** `{selected_item}`",
+        color=discord.Color.nitro_pink()
+    )
+
+    # Persist the ticket so the 🗑️ reaction and the auto-close survive a restart
+    created_at = time.time()
+    channel_id = str(channel.id)
+    ticket_store.set(channel_id, {
+        'guild_id': guild.id,
+        'user_id': member.id,
+        'item': selected_item,
+        'message_id': None,
+        'reservation_id': reservation_id,
+        'created_at': created_at,
+        'deadline': created_at + TICKET_TIMEOUT,
+    })
+    scheduler.schedule('ticket', channel_id, created_at + TICKET_TIMEOUT, guild.id)
+
+    # Ghost ping the user and mods; the ticket works without it
+    moderator_role = discord.utils.get(guild.roles, id=state.config.moderator)
+    mentions = [member.mention, f"<@{guild.owner_id}>"] + ([moderator_role.mention] if moderator_role else [])
+    try:
+        ghost_ping = await call_route(('messages', channel.id), channel.send(", ".join(mentions)))
+        await call_route(('messages', channel.id), ghost_ping.delete())
+    except discord.HTTPException as e:
+        print(f"Could not ping the ticket {channel.name}: {e}")
+
+    # Send the embedded message and add the reaction. Without them the ticket can't be used, so it is taken
+    # down again and the buyer is asked to retry with a clean slate.
+    try:
+        message = await call_route(('messages', channel.id), channel.send(embed=embed))
+        ticket_store.set(channel_id, {**ticket_store.data[channel_id], 'message_id': message.id})
+        watch_ticket(channel_id)
+        await call_route(('reactions', channel.id), message.add_reaction("🗑️"))
+    except Exception:
+        if channel_id in ticket_store.data:
+            await forget_ticket(channel_id)
+        try:
             await channel.delete()
+        except discord.HTTPException:
+            pass
+        raise
 
-    @discord.ui.button(label="Cancel", style=discord.ButtonStyle.secondary)
-    async def cancel_button(self, button, interaction):
-        # Handle the cancellation logic here
-        self.disable_all_items()
-        self.clear_items()
-        await interaction.response.edit_message(view=self)
+    try:
+        await status_message.edit(
+            embed=discord.Embed(
+                title="Ticket Created",
+                description=f"You have confirmed to buy `{selected_item}`\n"
+                            f"Current Stocks: `{available_stock(state, selected_item)}`"
+                            f"\n\n"
+                            f"{channel.mention}",
+                color=discord.Color.green()
+            )
+        )
+    except discord.HTTPException:
+        pass  # The interaction token expired while the ticket was queued
+
+
+async def ticket_worker():
+    while True:
+        interaction, selected_item, reservation_id, status_message = await ticket_queue.get()
+        try:
+            await provision_ticket(interaction, selected_item, reservation_id, status_message)
+        except Exception as e:
+            print(f"Failed to create a ticket for {interaction.user}: {e}")
+            await release_stock(get_guild_state(interaction.guild_id), reservation_id)
+            try:
+                await status_message.edit(
+                    embed=discord.Embed(
+                        title="Ticket Failed",
+                        description="Sorry, I couldn't create your ticket. Please try again in a moment.",
+                        color=discord.Color.red()
+                    )
+                )
+            except discord.HTTPException:
+                pass
+        finally:
+            ticket_queue.task_done()
 
-        # Create a new interaction to send the cancellation message
+
+class BuyNow(discord.ui.View):
+    def __init__(self, selected_item, quantity):
+        super().__init__(timeout=None, store=False)
+        item_id = item_key(selected_item)
+        self.add_item(discord.ui.Button(label="Confirm", style=discord.ButtonStyle.primary, custom_id=f"buy:{item_id}"))
+        self.add_item(discord.ui.Button(label="Cancel", style=discord.ButtonStyle.secondary,
+                                        custom_id=f"buy-cancel:{item_id}"))
+
+
+@component('buy')
+async def confirm_purchase(interaction: discord.Interaction, item_id):
+    await interaction.response.edit_message(view=None)
+
+    state = get_guild_state(interaction.guild_id)
+    selected_item = state.item_names.get(item_id)
+    reservation_id = None
+    if selected_item is not None:
+        reservation_id = await reserve_stock(state, selected_item, 1, interaction.user.id)
+    if reservation_id is None:
         await interaction.followup.send(
             embed=discord.Embed(
-                title="Ticket Canceled",
-                description="You have canceled the purchase.",
+                title="Out of Stock",
+                description=f"The selected item `{selected_item}` is currently out of stock.",
                 color=discord.Color.red()
             ),
             ephemeral=True
         )
+        return
+
+    # Acknowledge right away, the ticket channel is created by the provisioning workers
+    status_message = await interaction.followup.send(
+        embed=discord.Embed(
+            title="Creating Ticket",
+            description=f"You have confirmed to buy `{selected_item}`\n"
+                        f"Hang on while I create your ticket.",
+            color=discord.Color.blue()
+        ),
+        ephemeral=True,
+        wait=True
+    )
+    await ticket_queue.put((interaction, selected_item, reservation_id, status_message))
+
+
+@component('buy-cancel')
+async def cancel_purchase(interaction: discord.Interaction, item_id):
+    # Handle the cancellation logic here
+    await interaction.response.edit_message(view=None)
+
+    # Create a new interaction to send the cancellation message
+    await interaction.followup.send(
+        embed=discord.Embed(
+            title="Ticket Canceled",
+            description="You have canceled the purchase.",
+            color=discord.Color.red()
+        ),
+        ephemeral=True
+    )
 
 
 class DeleteNowConfirmationView(discord.ui.View):
     def __init__(self, name: str):
-        super().__init__()
-        self.name = name
+        super().__init__(timeout=None, store=False)
+        item_id = item_key(name)
+        self.add_item(discord.ui.Button(label="Confirm", style=discord.ButtonStyle.danger,
+                                        custom_id=f"delete:{item_id}"))
+        self.add_item(discord.ui.Button(label="Cancel", style=discord.ButtonStyle.secondary,
+                                        custom_id=f"delete-cancel:{item_id}"))
+
+
+def confirmation_item(interaction, item_id):
+    # The item a delete confirmation is about, read back from the message once it is gone from the catalog
+    name = get_guild_state(interaction.guild_id).item_names.get(item_id)
+    if name is None and interaction.message is not None and interaction.message.embeds:
+        description = interaction.message.embeds[0].description or ''
+        quoted = description[description.find('`') + 1:description.rfind('`')]
+        if item_key(quoted) == item_id:
+            name = quoted
+    return name
+
+
+@component('delete')
+async def confirm_delete(interaction: discord.Interaction, item_id):
+    state = get_guild_state(interaction.guild_id)
+    name = confirmation_item(interaction, item_id)
+    if not is_staff(interaction.user):
+        await respond_missing_role(interaction)
+        return
+    if name in state.stocks_data:
+        state.stock_store.pop(name)
+        embed = discord.Embed(description=f"The stock item `{name}` has been deleted.")
 
-    @discord.ui.button(label="Confirm", style=discord.ButtonStyle.danger)
-    async def confirm_button(self, button, interaction):
-        if self.name in stocks_data:
-            stocks_data.pop(self.name)
-            embed = discord.Embed(description=f"The stock item `{self.name}` has been deleted.")
+    else:
+        embed = discord.Embed(description=f"The stock item '{name}' was not found.")
+    await interaction.response.edit_message(embed=embed, view=None)
 
-        else:
-            embed = discord.Embed(description=f"The stock item '{self.name}' was not found.")
-        await interaction.response.edit_message(embed=embed, view=None)
 
-        saveJson(stocks_data, "stocks_data.json")
+@component('delete-cancel')
+async def cancel_delete(interaction: discord.Interaction, item_id):
+    name = confirmation_item(interaction, item_id)
+    embed = discord.Embed(
+        description=f"The cancellation of the deletion for stock item `{name}` has been successful.")
+    await interaction.response.edit_message(embed=embed, view=None)
 
-    @discord.ui.button(label="Cancel", style=discord.ButtonStyle.secondary)
-    async def cancel_button(self, button, interaction):
-        embed = discord.Embed(
-            description=f"The cancellation of the deletion for stock item `{self.name}` has been successful.")
-        await interaction.response.edit_message(embed=embed, view=None)
 
+# Stock Browser
+# One paginated item picker shared by /stocks, /warranty, /edit and /delete. Only the current page is
+# rendered, and rendered pages are cached until the catalog or the reservations change.
+
+STOCK_FILTERS = {
+    'all': 'All items',
+    'in_stock': 'In stock',
+    'out_of_stock': 'Out of stock',
+}
+ITEMS_PER_PAGE = 15  # Three rows of buttons, leaving room for the filter and navigation rows
 
-class ViewStockButtons(discord.ui.View):
-    def __init__(self, data):
-        super().__init__()
-        self.stocks_data = data
 
-        for name, quantity in self.stocks_data.items():
+def catalog_page(state, stock_filter, page):
+    catalog_cache = state.catalog_cache
+    version = (state.stock_store.version, state.reservation_store.version)
+    if catalog_cache['version'] != version:
+        catalog_cache.update(version=version, names={}, pages={})
 
+    if stock_filter not in catalog_cache['names']:
+        if stock_filter == 'in_stock':
+            names = [name for name in state.stocks_data if available_stock(state, name) > 0]
+        elif stock_filter == 'out_of_stock':
+            names = [name for name in state.stocks_data if available_stock(state, name) <= 0]
+        else:
+            names = list(state.stocks_data)
+        catalog_cache['names'][stock_filter] = names
+    names = catalog_cache['names'][stock_filter]
+    page_count = max((len(names) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE, 1)
+    page = min(max(page, 0), page_count - 1)
+
+    if (stock_filter, page) not in catalog_cache['pages']:
+        entries = []
+        for name in names[page * ITEMS_PER_PAGE:(page + 1) * ITEMS_PER_PAGE]:
+            quantity = available_stock(state, name)
             if quantity <= 0:
                 quantity = 'Out of Stock'
+            entries.append((name, f"{name} ({quantity})"[:80]))
+        catalog_cache['pages'][(stock_filter, page)] = entries
+    return catalog_cache['pages'][(stock_filter, page)], page, page_count
+
+
+class StockPager(discord.ui.View):
+    # mode is one of buy, board, warranty, edit or delete; argument carries what the mode needs (the buyer for
+    # warranty). board is buy on the public stock board, whose paging opens a private pager instead.
+    def __init__(self, state, mode, argument='', page=0, stock_filter='all'):
+        super().__init__(timeout=None, store=False)
+        entries, page, page_count = catalog_page(state, stock_filter, page)
+        prefix = f"{mode}:{argument}"
+
+        for name, label in entries:
+            self.add_item(discord.ui.Button(label=label, custom_id=f"pick:{prefix}:{item_key(name)}",
+                                            style=discord.ButtonStyle.secondary))
+
+        self.add_item(discord.ui.Select(
+            custom_id=f"filter:{prefix}",
+            row=3,
+            options=[discord.SelectOption(label=label, value=value, default=value == stock_filter)
+                     for value, label in STOCK_FILTERS.items()]
+        ))
+
+        self.add_item(discord.ui.Button(label="◀", row=4, custom_id=f"page:{prefix}:{stock_filter}:{page - 1}",
+                                        disabled=page == 0))
+        self.add_item(discord.ui.Button(label=f"Page {page + 1}/{page_count}", row=4,
+                                        custom_id=f"page:{prefix}:{stock_filter}:{page}", disabled=True))
+        self.add_item(discord.ui.Button(label="▶", row=4, custom_id=f"page:{prefix}:{stock_filter}:{page + 1}",
+                                        disabled=page >= page_count - 1))
+
+
+async def show_page(interaction: discord.Interaction, mode, argument, stock_filter, page):
+    state = get_guild_state(interaction.guild_id)
+    if mode == 'board':
+        # The board is shared by everyone who sees it, so each customer browses a copy of their own
+        await interaction.response.send_message(view=StockPager(state, 'buy', argument, page, stock_filter),
+                                                ephemeral=True)
+        return
+    await interaction.response.edit_message(view=StockPager(state, mode, argument, page, stock_filter))
 
-            label = f"{name} ({quantity})"
-            button = discord.ui.Button(label=label, custom_id=name, style=discord.ButtonStyle.secondary)
-            button.callback = lambda i, b=button: self.on_button_click(i, b)  # Set the callback function
-            self.add_item(button)
 
-    async def on_button_click(self, interaction: discord.Interaction, button: discord.ui.Button):
-        selected_item = button.custom_id
-        quantity = self.stocks_data[selected_item]
+@component('page')
+async def change_page(interaction: discord.Interaction, mode, argument, stock_filter, page):
+    await show_page(interaction, mode, argument, stock_filter, int(page))
 
-        if quantity <= 0:
-            await interaction.response.send_message(
-                embed=discord.Embed(
-                    title="Out of Stock",
-                    description=f"`{selected_item}` is currently out of stock.\n",
-                    color=discord.Color.red()
-                ), ephemeral=True)
-            return
-        else:
-            await interaction.response.send_message(
-                embed=discord.Embed(
-                    title="Confirmation",
-                    description=f"Do you want to buy `{selected_item}`?\n"
-                                f"If you press confirm, I will create a ticket for you.",
-                    color=discord.Color.blue()
-                ),
-                ephemeral=True,
-                view=BuyNow(selected_item, quantity)
-            )
+
+@component('filter')
+async def change_filter(interaction: discord.Interaction, mode, argument):
+    await show_page(interaction, mode, argument, interaction.data['values'][0], 0)
+
+
+@component('pick')
+async def pick_item(interaction: discord.Interaction, mode, argument, item_id):
+    selected_item = get_guild_state(interaction.guild_id).item_names.get(item_id)
+    if selected_item is None:
+        await interaction.response.send_message(
+            embed=discord.Embed(description="This item no longer exists.", color=discord.Color.red()),
+            ephemeral=True)
+        return
+
+    if mode in ('buy', 'board'):
+        await show_buy_confirmation(interaction, selected_item)
+        return
+    if not is_staff(interaction.user):
+        await respond_missing_role(interaction)
+        return
+
+    if mode == 'warranty':
+        user = await bot.get_or_fetch_user(int(argument))
+
+        async def get_modal_variables(quantity, link, item):
+            await send_warranty(interaction, user, item, quantity, link)
+
+        await warranty_item_picker(get_modal_variables)(interaction, selected_item)
+    elif mode == 'edit':
+        async def get_model_variables(quantity, name):
+            pass
+
+        await quantity_item_picker(get_model_variables)(interaction, selected_item)
+    elif mode == 'delete':
+        await show_delete_confirmation(interaction, selected_item)
+
+
+async def show_buy_confirmation(interaction: discord.Interaction, selected_item):
+    quantity = available_stock(get_guild_state(interaction.guild_id), selected_item)
+
+    if quantity <= 0:
+        await interaction.response.send_message(
+            embed=discord.Embed(
+                title="Out of Stock",
+                description=f"`{selected_item}` is currently out of stock.\n",
+                color=discord.Color.red()
+            ), ephemeral=True)
+        return
+    else:
+        await interaction.response.send_message(
+            embed=discord.Embed(
+                title="Confirmation",
+                description=f"Do you want to buy `{selected_item}`?\n"
+                            f"If you press confirm, I will create a ticket for you.",
+                color=discord.Color.blue()
+            ),
+            ephemeral=True,
+            view=BuyNow(selected_item, quantity)
+        )
 
 
 # Warranty Classes
@@ -305,30 +2018,9 @@ class WarrantyModal(discord.ui.Modal):
         await self.get_modal_variables(quantity, link, item)
 
 
-class ViewWarrantyButtons(discord.ui.View):
-    def __init__(self, data, get_modal_variables):
-        super().__init__()
-        self.stocks_data = data
-        self.get_modal_variables = get_modal_variables
-        self.selected_quantity = None  # Initialize selected_quantity as None
-
-        for name, quantity in self.stocks_data.items():
-
-            if quantity <= 0:
-                quantity = 'Out of Stock'
-
-            label = f"{name} ({quantity})"
-            button = discord.ui.Button(label=label, custom_id=name, style=discord.ButtonStyle.secondary)
-            button.callback = lambda i, b=button: self.on_button_click(i, b)  # Set the callback function
-            self.add_item(button)
-
-    async def on_button_click(self, interaction: discord.Interaction, button: discord.ui.Button):
-        selected_item = button.custom_id
-        self.disable_all_items()
-        self.clear_items()
-        self.selected_quantity = self.stocks_data[selected_item]  # Store the selected quantity
-
-        if self.selected_quantity <= 0:
+def warranty_item_picker(get_modal_variables):
+    async def on_select(interaction: discord.Interaction, selected_item):
+        if get_guild_state(interaction.guild_id).stocks_data.get(selected_item, 0) <= 0:
             await interaction.response.send_message(
                 embed=discord.Embed(
                     title="Out of Stock",
@@ -339,9 +2031,12 @@ class ViewWarrantyButtons(discord.ui.View):
             return
         else:
             await interaction.response.send_modal(
-                WarrantyModal(title="Warranty Information", get_modal_variables=self.get_modal_variables,
+                WarrantyModal(title="Warranty Information", get_modal_variables=get_modal_variables,
                               selected_item=selected_item))
-            await interaction.followup.edit_message(message_id=interaction.message.id, view=self)
+            if interaction.message is not None:
+                await interaction.followup.edit_message(message_id=interaction.message.id, view=None)
+
+    return on_select
 
 
 # Stock Edit Quantity Classes
@@ -368,6 +2063,7 @@ class QuantityModal(discord.ui.Modal):
             return
 
         # Assign Variables
+        state = get_guild_state(interaction.guild_id)
         f_quantity = self.quantity
         f_name = self.name
 
@@ -376,71 +2072,37 @@ class QuantityModal(discord.ui.Modal):
             pass
         else:
             f_quantity = self.children[1].value
-            stocks_data[self.name] = int(f_quantity)
+            state.stock_store.set(self.name, int(f_quantity))
 
         # If the user didn't change the name
         if self.children[0].value == '':
             pass
         else:
             f_name = self.children[0].value
-            stocks_data[self.children[0].value] = stocks_data.pop(self.name)
+            state.stock_store.set(self.children[0].value, state.stock_store.pop(self.name))
+            rename_reservations(state, self.name, f_name)
 
-        saveJson(stocks_data, "stocks_data.json")
         await interaction.response.send_message("The item have been successfully edited.", ephemeral=True)
         await self.get_modal_variables(f_quantity, f_name)
         return
 
 
-class ViewQuantityButtons(discord.ui.View):
-    def __init__(self, data, get_modal_variables):
-        super().__init__()
-        self.stocks_data = data
-        self.get_modal_variables = get_modal_variables
-        self.selected_quantity = None  # Initialize selected_quantity as None
-
-        for name, quantity in self.stocks_data.items():
-            if quantity <= 0:
-                quantity = 'Out of Stock'
-            label = f"{name} ({quantity})"
-            button = discord.ui.Button(label=label, custom_id=name, style=discord.ButtonStyle.secondary)
-            button.callback = lambda i, b=button: self.on_button_click(i, b)  # Set the callback function
-            self.add_item(button)
-
-    async def on_button_click(self, interaction: discord.Interaction, button: discord.ui.Button):
-        selected_item = button.custom_id
-        self.disable_all_items()
-        self.clear_items()
-        self.selected_quantity = self.stocks_data[selected_item]  # Store the selected quantity
-
+def quantity_item_picker(get_modal_variables):
+    async def on_select(interaction: discord.Interaction, selected_item):
         await interaction.response.send_modal(
-            QuantityModal(title="Item Information", get_modal_variables=self.get_modal_variables, name=selected_item,
-                          quantity=self.selected_quantity))
+            QuantityModal(title="Item Information", get_modal_variables=get_modal_variables, name=selected_item,
+                          quantity=get_guild_state(interaction.guild_id).stocks_data[selected_item]))
+
+    return on_select
 
 
 # Delete Classes
 
-class ViewDeleteButtons(discord.ui.View):
-    def __init__(self, data):
-        super().__init__()
-        self.stocks_data = data
-        self.selected_quantity = None
-
-        for name, quantity in self.stocks_data.items():
-            if quantity <= 0:
-                quantity = 'Out of Stock'
-            label = f"{name} ({quantity})"
-            button = discord.ui.Button(label=label, custom_id=name, style=discord.ButtonStyle.secondary)
-            button.callback = lambda i, b=button: self.on_button_click(i, b)  # Set the callback function
-            self.add_item(button)
-
-    async def on_button_click(self, interaction: discord.Interaction, button: discord.ui.Button):
-        selected_item = button.custom_id
-        self.selected_quantity = self.stocks_data[selected_item]  # Store the selected quantity
-        embed = discord.Embed()
-        embed.description = f"Are you sure you want to delete the stock item `{selected_item}`?"
-        await interaction.response.send_message(embed=embed, view=DeleteNowConfirmationView(selected_item),
-                                                ephemeral=True)
-        # await interaction.followup.edit_message(message_id=interaction.message.id, view=self)
+async def show_delete_confirmation(interaction: discord.Interaction, selected_item):
+    embed = discord.Embed()
+    embed.description = f"Are you sure you want to delete the stock item `{selected_item}`?"
+    await interaction.response.send_message(embed=embed, view=DeleteNowConfirmationView(selected_item),
+                                            ephemeral=True)
 
 
 # New Classes
@@ -469,23 +2131,199 @@ class NewModal(discord.ui.Modal):
         embed.add_field(name="Quantity", value=self.children[1].value)
         await interaction.response.send_message(embeds=[embed])
 
-        stocks_data[name] = quantity
-        saveJson(stocks_data, "stocks_data.json")
+        get_guild_state(interaction.guild_id).stock_store.set(name, quantity)
+
+
+def item_key(name):
+    # Short, stable id for an item name, small enough for a custom_id
+    return hashlib.blake2b(name.encode(), digest_size=6).hexdigest()
+
+
+# Item Autocomplete
+
+class ItemIndex:
+    # Sorted names for prefix lookups plus a trigram index for matches in the middle of a name.
+    # Both are updated one name at a time as the catalog changes.
+    MAX_RESULTS = 25  # Discord shows at most 25 autocomplete choices
 
+    def __init__(self, names):
+        self.sorted_names = sorted((name.lower(), name) for name in names)
+        self.trigrams = {}
+        for _, name in self.sorted_names:
+            self.index_trigrams(name)
 
-stocks_data = openJson(directory)
+    @staticmethod
+    def trigrams_of(text):
+        text = text.lower()
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def index_trigrams(self, name):
+        for trigram in self.trigrams_of(name):
+            self.trigrams.setdefault(trigram, set()).add(name)
+
+    def add(self, name):
+        entry = (name.lower(), name)
+        position = bisect.bisect_left(self.sorted_names, entry)
+        if position < len(self.sorted_names) and self.sorted_names[position] == entry:
+            return
+        self.sorted_names.insert(position, entry)
+        self.index_trigrams(name)
+
+    def remove(self, name):
+        entry = (name.lower(), name)
+        position = bisect.bisect_left(self.sorted_names, entry)
+        if position < len(self.sorted_names) and self.sorted_names[position] == entry:
+            del self.sorted_names[position]
+        for trigram in self.trigrams_of(name):
+            names = self.trigrams.get(trigram)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self.trigrams[trigram]
+
+    def search(self, query):
+        query = query.lower()
+        results = []
+        position = bisect.bisect_left(self.sorted_names, (query,))
+        while position < len(self.sorted_names) and len(results) < self.MAX_RESULTS:
+            lowered, name = self.sorted_names[position]
+            if not lowered.startswith(query):
+                break
+            results.append(name)
+            position += 1
+
+        if len(results) < self.MAX_RESULTS and len(query) >= 3:
+            candidates = None
+            for trigram in self.trigrams_of(query):
+                names = self.trigrams.get(trigram, set())
+                candidates = names if candidates is None or len(names) < len(candidates) else candidates
+            found = set(results)
+            for name in sorted(candidates or ()):
+                if name not in found and query in name.lower():
+                    results.append(name)
+                    if len(results) >= self.MAX_RESULTS:
+                        break
+        return results
+
+
+async def item_autocomplete(ctx: discord.AutocompleteContext):
+    return get_guild_state(ctx.interaction.guild_id).item_index.search(ctx.value or '')
+
+
+@templates.template('unknown item')
+def unknown_item_template(scope):
+    return discord.Embed(title="Stock Items", description="The stock item `{item}` was not found.",
+                         color=discord.Color.red())
+
+
+@templates.template('empty catalog')
+def empty_catalog_template(scope):
+    return discord.Embed(title="Stock Items", description="There are no items saved on my list.")
+
+
+async def respond_unknown_item(ctx, item):
+    await ctx.respond(embed=templates.render('unknown item', item=item), ephemeral=True)
 
 
 @bot.slash_command(description="Display a list of items currently in stock.")
 async def stocks(ctx: commands.Context):
-    if len(stocks_data) <= 0:
-        embed = discord.Embed(title="Stock Items", description="There are no items saved on my list.")
-        await ctx.respond(embed=embed, ephemeral=True)
+    state = get_guild_state(ctx.guild.id)
+    if len(state.stocks_data) <= 0:
+        await ctx.respond(embed=templates.render('empty catalog'), ephemeral=True)
         return
-    view = ViewStockButtons(stocks_data)
+    view = StockPager(state, 'buy')
     await ctx.respond(view=view, ephemeral=True)
 
 
+# Stock Board
+# One public stock message per guild, kept up to date by the bot. Catalog and reservation changes only
+# mark the boards dirty; the updater coalesces them into at most one edit per board every
+# BOARD_UPDATE_INTERVAL seconds and skips the edit when the rendered board is unchanged.
+
+BOARD_UPDATE_INTERVAL = 10
+board_store = state_backend.open('boards.json', guild_of=lambda guild_id, board: int(guild_id))  # guild id -> {channel_id, message_id}
+board_hashes = {}  # guild id -> hash of the content currently shown
+dirty_boards = set()  # guild ids whose board needs a refresh
+board_dirty = asyncio.Event()
+
+
+def mark_board_dirty(guild_id):
+    if str(guild_id) in board_store.data:
+        dirty_boards.add(str(guild_id))
+        board_dirty.set()
+
+
+def render_board(state):
+    embed = discord.Embed(title="Stock Items", color=discord.Color.blue())
+    lines = []
+    length = 0
+    for position, name in enumerate(state.stocks_data):
+        quantity = available_stock(state, name)
+        line = f"`{name}` - **{quantity if quantity > 0 else 'Out of Stock'}**"
+        if length + len(line) > 3900:
+            lines.append(f"...and {len(state.stocks_data) - position} more, use the buttons below.")
+            break
+        lines.append(line)
+        length += len(line) + 1
+    embed.description = "\n".join(lines) if lines else "There are no items saved on my list."
+    embed.set_footer(text="Press an item to buy it.")
+    view = StockPager(state, 'board') if state.stocks_data else None
+    content_hash = hashlib.blake2b(json.dumps(
+        [embed.to_dict(), view.to_components() if view else None], sort_keys=True).encode()).hexdigest()
+    return embed, view, content_hash
+
+
+async def board_updater():
+    while True:
+        await board_dirty.wait()
+        board_dirty.clear()
+        guild_ids = list(dirty_boards)
+        dirty_boards.clear()
+        for guild_id in guild_ids:
+            board = board_store.data.get(guild_id)
+            if board is None:
+                continue
+            embed, view, content_hash = render_board(get_guild_state(int(guild_id)))
+            if board_hashes.get(guild_id) == content_hash:
+                continue
+            channel = bot.get_channel(board['channel_id'])
+            try:
+                if channel is None:
+                    raise discord.NotFound
+                await channel.get_partial_message(board['message_id']).edit(embed=embed, view=view)
+                board_hashes[guild_id] = content_hash
+            except discord.NotFound:
+                board_store.pop(guild_id)  # The board message or its channel was deleted
+            except discord.HTTPException as e:
+                print(f"Failed to update the stock board of guild {guild_id}: {e}")
+        await asyncio.sleep(BOARD_UPDATE_INTERVAL)
+
+
+@bot.slash_command(description="Post a live stock board that the bot keeps up to date.")
+@has_required_role()
+async def board(ctx: commands.Context,
+                channel: discord.Option(discord.TextChannel, "Where to post the board", required=False,
+                                        default=None)):
+    channel = channel or ctx.channel
+    embed, view, content_hash = render_board(get_guild_state(ctx.guild.id))
+    message = await channel.send(embed=embed, view=view)
+    try:
+        await message.pin()
+    except discord.HTTPException:
+        pass  # Missing the Manage Messages permission, the board still works unpinned
+
+    guild_id = str(ctx.guild.id)
+    previous = board_store.data.get(guild_id)
+    board_store.set(guild_id, {'channel_id': channel.id, 'message_id': message.id})
+    board_hashes[guild_id] = content_hash
+    if previous is not None:
+        try:
+            await bot.get_channel(previous['channel_id']).get_partial_message(previous['message_id']).delete()
+        except (AttributeError, discord.HTTPException):
+            pass
+    await ctx.respond(f"The stock board has been posted in {channel.mention}.", ephemeral=True)
+
+
 @bot.slash_command(description="Create a new item from the stock list.")
 @has_required_role()
 async def new(ctx: commands.Context):
@@ -495,244 +2333,939 @@ async def new(ctx: commands.Context):
 
 @bot.slash_command(description="Remove a specific item from the stock list.")
 @has_required_role()
-async def delete(ctx: commands.Context):
-    await ctx.respond(view=ViewDeleteButtons(stocks_data), ephemeral=True)
+async def delete(ctx: commands.Context,
+                 item: discord.Option(str, "The item to delete", autocomplete=item_autocomplete,
+                                      required=False, default=None)):
+    state = get_guild_state(ctx.guild.id)
+    if item is not None:
+        if item not in state.stocks_data:
+            await respond_unknown_item(ctx, item)
+            return
+        await show_delete_confirmation(ctx.interaction, item)
+        return
+    await ctx.respond(view=StockPager(state, 'delete'), ephemeral=True)
 
 
 @bot.slash_command(description="Modify the name and quantity of a specific item in the stock list.")
 @has_required_role()
-async def edit(ctx: commands.Context):
+async def edit(ctx: commands.Context,
+               item: discord.Option(str, "The item to edit", autocomplete=item_autocomplete,
+                                    required=False, default=None)):
     async def get_model_variables(quantity, name):
         pass
 
-    await ctx.respond(view=ViewQuantityButtons(stocks_data, get_modal_variables=get_model_variables), ephemeral=True)
+    state = get_guild_state(ctx.guild.id)
+    if item is not None:
+        if item not in state.stocks_data:
+            await respond_unknown_item(ctx, item)
+            return
+        await quantity_item_picker(get_model_variables)(ctx.interaction, item)
+        return
+    await ctx.respond(view=StockPager(state, 'edit'), ephemeral=True)
+
+
+# Order Ledger
+# Every order sent through /warranty, with its final state, in SQLite (WAL mode) indexed by reference
+# code, buyer and item. Queries run in a worker thread so the event loop never waits on the disk.
+
+class OrderLedger:
+    COLUMNS = ('reference_code', 'guild_id', 'channel_id', 'item', 'quantity', 'user_id', 'verifier_id',
+               'moderator_id', 'state', 'created_at', 'updated_at')
+
+    def __init__(self, file_path):
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS orders ("
+                "reference_code TEXT PRIMARY KEY, guild_id INTEGER, channel_id INTEGER, item TEXT, "
+                "quantity INTEGER, user_id INTEGER, verifier_id INTEGER, moderator_id INTEGER, state TEXT, "
+                "created_at REAL, updated_at REAL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS orders_user ON orders (user_id, created_at)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS orders_item ON orders (item, created_at)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS transcripts ("
+                "channel_id INTEGER PRIMARY KEY, guild_id INTEGER, user_id INTEGER, item TEXT, path TEXT, "
+                "messages INTEGER, created_at REAL, archived_at REAL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS transcripts_user ON transcripts (user_id, created_at)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS orders_channel ON orders (channel_id)")
+
+    def execute(self, sql, parameters=()):
+        with self.lock, self.connection:
+            return [dict(row) for row in self.connection.execute(sql, parameters).fetchall()]
+
+    def execute_many(self, sql, rows):
+        with self.lock, self.connection:
+            self.connection.executemany(sql, rows)
+
+    async def add(self, reference_code, record):
+        await self.add_many({reference_code: record})
+
+    async def add_many(self, records):
+        # Every order of the batch goes in with one transaction
+        orders = [{
+            'reference_code': reference_code,
+            'moderator_id': None,
+            'updated_at': record['created_at'],
+            **{column: record.get(column) for column in self.COLUMNS if column in record},
+        } for reference_code, record in records.items()]
+        await in_thread(
+            self.execute_many,
+            f"INSERT OR REPLACE INTO orders ({', '.join(self.COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(self.COLUMNS))})",
+            [[order.get(column) for column in self.COLUMNS] for order in orders]
+        )
 
+    async def set_state(self, reference_code, state, moderator_id=None):
+        await in_thread(
+            self.execute,
+            "UPDATE orders SET state = ?, moderator_id = COALESCE(?, moderator_id), updated_at = ? "
+            "WHERE reference_code = ?",
+            (state, moderator_id, time.time(), reference_code)
+        )
 
-@bot.slash_command(description="Send a warranty activation message to a user.")
-@has_required_role()
-async def warranty(ctx: commands.Context, user: discord.User):
-    m_quantity = None
-    m_link = None
-    m_item = None
+    async def find(self, guild_id, reference_code):
+        rows = await in_thread(
+            self.execute, "SELECT * FROM orders WHERE reference_code = ? AND guild_id = ?", (reference_code, guild_id))
+        return rows[0] if rows else None
+
+    async def add_transcript(self, channel_id, record, path, messages):
+        await in_thread(
+            self.execute,
+            "INSERT OR REPLACE INTO transcripts (channel_id, guild_id, user_id, item, path, messages, created_at, "
+            "archived_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (channel_id, record['guild_id'], record['user_id'], record['item'], path, messages,
+             record.get('created_at'), time.time())
+        )
 
-    async def get_modal_variables(quantity, link, item):
-        nonlocal m_quantity
-        nonlocal m_link
-        nonlocal m_item
-        m_quantity = quantity
-        m_link = link
-        m_item = item
+    async def transcripts(self, guild_id, user_id=None, reference_code=None, limit=10):
+        if reference_code is not None:
+            sql = ("SELECT transcripts.* FROM transcripts JOIN orders ON orders.channel_id = transcripts.channel_id "
+                   "WHERE orders.reference_code = ?")
+            parameters = (reference_code,)
+        else:
+            sql, parameters = "SELECT * FROM transcripts WHERE user_id = ?", (user_id,)
+        return await in_thread(
+            self.execute, sql + " AND transcripts.guild_id = ? ORDER BY transcripts.created_at DESC LIMIT ?",
+            (*parameters, guild_id, limit))
+
+    async def latest(self, guild_id, user_id=None, item=None, limit=10):
+        if user_id is not None:
+            sql, parameters = "SELECT * FROM orders WHERE user_id = ?", (user_id,)
+        else:
+            sql, parameters = "SELECT * FROM orders WHERE item = ?", (item,)
+        return await in_thread(
+            self.execute, sql + " AND guild_id = ? ORDER BY created_at DESC LIMIT ?", (*parameters, guild_id, limit))
+
+
+ledger = OrderLedger('orders.db')
+
+
+# Vouch Images
+# Each vouch image is streamed in (at most VOUCH_IMAGE_LIMIT bytes), decoded and reduced to a 64-bit
+# difference hash in a process pool, and looked up among the hashes of every earlier vouch in the guild.
+# The index files each hash under its four 16-bit chunks: two hashes at most 7 bits apart agree on one
+# chunk up to a single bit, so a lookup probes 4 x 17 buckets instead of comparing every stored hash.
+
+VOUCH_IMAGE_LIMIT = 8 * 2 ** 20  # Bytes
+HASH_DISTANCE = 6  # Differing bits under which two images count as the same screenshot, at most 7
+HASH_WORKERS = 2
+IMAGE_TIMEOUT = 15  # Seconds to download a vouch image before the notification goes out without the check
+REUSED_SHOWN = 5  # Earlier vouches listed in the notification
+hash_pool = None  # Process pool, started with the first vouch
+image_session = None
+
+
+def image_hash(data):
+    # Runs in the process pool: the event loop never decodes an image
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.draft('L', (64, 64))  # JPEGs are decoded straight to a small greyscale image
+            pixels = image.convert('L').resize((9, 8), Image.LANCZOS).tobytes()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            value = value << 1 | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return value
+
+
+class HashIndex:
+    def __init__(self):
+        self.hashes = {}  # key -> hash
+        self.chunks = [{} for _ in range(4)]  # for each 16-bit chunk: chunk value -> keys
+
+    def add(self, key, value):
+        self.hashes[key] = value
+        for position, table in enumerate(self.chunks):
+            table.setdefault((value >> position * 16) & 0xffff, []).append(key)
+
+    def near(self, value, distance=HASH_DISTANCE):
+        # [(distance, key)] of every stored hash within distance bits, closest first
+        found = {}
+        for position, table in enumerate(self.chunks):
+            chunk = (value >> position * 16) & 0xffff
+            for probe in (chunk, *(chunk ^ 1 << bit for bit in range(16))):
+                for key in table.get(probe, ()):
+                    if key not in found:
+                        found[key] = (self.hashes[key] ^ value).bit_count()
+        return sorted((bits, key) for key, bits in found.items() if bits <= distance)
+
+
+# "<message id>:<attachment position>" -> {guild_id, user_id, reference_code, hash, url}
+vouch_hash_store = state_backend.open('vouch_hashes.json', guild_of=lambda key, record: record['guild_id'])
+vouch_indexes = {}  # guild id -> HashIndex, built on the guild's first vouch
+
+
+def vouch_index(guild_id):
+    if guild_id not in vouch_indexes:
+        index = vouch_indexes[guild_id] = HashIndex()
+        for key, record in vouch_hash_store.data.items():
+            if record['guild_id'] == guild_id:
+                index.add(key, int(record['hash'], 16))
+    return vouch_indexes[guild_id]
+
+
+async def read_attachment(attachment):
+    # Streamed, so an oversized file is dropped at the limit instead of being read whole
+    global image_session
+    if attachment.size > VOUCH_IMAGE_LIMIT:
+        return None
+    if image_session is None:
+        image_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=IMAGE_TIMEOUT))
+    data = bytearray()
+    async with image_session.get(attachment.url) as response:
+        if response.status != 200:
+            return None
+        async for chunk in response.content.iter_chunked(65536):
+            data += chunk
+            if len(data) > VOUCH_IMAGE_LIMIT:
+                return None
+    return bytes(data)
+
+
+async def find_reused_images(reference_code, record, message):
+    # Earlier vouches that the images of this one are near-duplicates of; the images are then indexed too
+    global hash_pool
+    if Image is None:
+        return []
+    index = vouch_index(record['guild_id'])
+    reused = {}
+    for position, attachment in enumerate(message.attachments):
+        if not attachment.filename.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        try:
+            data = await read_attachment(attachment)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Could not download the vouch image of warranty {reference_code}: {e!r}")
+            continue
+        if data is None:
+            continue
+        if hash_pool is None:
+            hash_pool = concurrent.futures.ProcessPoolExecutor(HASH_WORKERS)
+        started = time.perf_counter()
+        value = await asyncio.get_running_loop().run_in_executor(hash_pool, image_hash, data)
+        observe('thread', 'image_hash', time.perf_counter() - started)
+        if value is None:
+            continue
+        for distance, key in index.near(value):
+            earlier = vouch_hash_store.data[key]
+            if earlier['reference_code'] != reference_code and earlier['url'] not in reused:
+                reused[earlier['url']] = {'url': earlier['url'], 'user_id': earlier['user_id'],
+                                          'reference_code': earlier['reference_code'], 'distance': distance}
+        key = f"{message.id}:{position}"
+        vouch_hash_store.set(key, {'guild_id': record['guild_id'], 'user_id': record['user_id'],
+                                   'reference_code': reference_code, 'hash': f"{value:016x}",
+                                   'url': message.jump_url})
+        index.add(key, value)
+    return sorted(reused.values(), key=lambda match: match['distance'])[:REUSED_SHOWN]
+
+
+# Warranty State
+# Open warranties are persisted by reference code and move sent -> vouched -> activated, or sent -> voided
+# once their deadline passes. Gateway events and the scheduler drive every transition.
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+ph_timezone = pytz.timezone('Asia/Manila')
+warranty_store = state_backend.open('warranties.json', guild_of=lambda code, record: record['guild_id'])
+warranty_waits = {}  # reference code -> (kind, key, entry) of its registered wait
+
+
+def format_deadline(timestamp):
+    deadline_ph = datetime.datetime.fromtimestamp(timestamp, ph_timezone)
+    return f"{deadline_ph.strftime('%Y-%m-%d %I:%M')} {deadline_ph.strftime('%p').upper()}"
+
+
+def warranty_pending_embed(record, reference_code, color=0x00ffff):
+    user_mention = f"<@{record['user_id']}>"
+    return discord.Embed(
+        title="Warranty Activation",
+        description=f"The warranty activation has been sent to {user_mention}\n\n"
+                    f"**Note:** The warranty will be **AUTOMATICALLY** voided if {user_mention} doesn't vouch in <#{record['vouch_channel']}> within **{convert_seconds_to_hours(record['due'])}** of receiving the warranty activation message.\n\n"
+                    f"I will notify you if the user {user_mention} sent an image to the <#{record['vouch_channel']}>.\n\n"
+                    f"Reference Code: `{reference_code}`\n"
+                    f"Due Date: `{format_deadline(record['deadline'])}`\n\n"
+                    f"Verifier: <@{record['verifier_id']}>",
+        color=color)
+
+
+def update_warranty(reference_code, **changes):
+    record = {**warranty_store.data[reference_code], **changes}
+    warranty_store.set(reference_code, record)
+    return record
+
+
+def is_vouch_image(message):
+    return any(attachment.filename.lower().endswith(IMAGE_EXTENSIONS) for attachment in message.attachments)
+
+
+def is_lock_reaction(payload):
+    return (
+            str(payload.emoji) == "🔒"
+            and payload.user_id != bot.user.id
+            and payload.member is not None
+            and discord.utils.get(payload.member.roles,
+                                  id=get_guild_state(payload.guild_id).config.moderator) is not None
+    )
 
-        async def send_warranty(ctx, user):
 
-            nonlocal m_quantity
-            nonlocal m_link
+def watch_warranty(reference_code):
+    # Register the gateway wait for the record's current state
+    unwatch_warranty(reference_code)
+    record = warranty_store.data[reference_code]
+    if record['state'] == 'sent':
+        kind, key = "message", (record['vouch_channel'], record['user_id'])
+        entry = waits.register(kind, key, is_vouch_image,
+                               lambda message: on_warranty_vouched(reference_code, message))
+    elif record['state'] == 'vouched' and record.get('notification_message_id'):
+        kind, key = "reaction", record['notification_message_id']
+        entry = waits.register(kind, key, is_lock_reaction,
+                               lambda payload: on_warranty_locked(reference_code, payload.member))
+    else:
+        return
+    warranty_waits[reference_code] = (kind, key, entry)
 
-            try:
-                reference_code = await generate_reference_code()
-
-                # Get the current date, and await get_timer_value() data
-                ph_timezone = pytz.timezone('Asia/Manila')
-                current_time_ph = datetime.datetime.now(ph_timezone)
-                deadline_ph = current_time_ph + datetime.timedelta(seconds=await get_timer_value())
-
-                # Get the vouch channel
-                target_channel = bot.get_channel(await get_vouch_channel_id())
-
-                if m_link == '':
-                    message_template = (
-                        "**.별 : a message has been received.**\n\n"
-                        f"<a:pink_arrow:1116611362861351045> **{m_item}** - **x{quantity}**\n"
-                        f"Reference Code: `{await generate_reference_code()}`\n\n"
-                        "<a:dot_blow:1139089076578947173> please read <#1100371712509493296> before and after purchasing.\n"
-                        f"<a:dot_blow:1139089076578947173> vouch at <#1095348388284862485> within **{convert_seconds_to_hours(await get_timer_value())}** to activate warranty.\n"
-                        "<a:dot_blow:1139089076578947173> don't forget to write the right format or else it will be voided.\n"
-                        "<a:dot_blow:1139089076578947173> no vouch = no warranty\n\n"
-                        "thank you so much for trusting us.\n"
-                        "balik po kayo\n\n"
-                        "love, calliope <:starguardian:1116890190003314749>"
-                    )
-                else:
-                    m_link = m_link.split()
-                    message_template = (
-                        "**.별 : a message has been received.**\n\n"
-                        f"<a:pink_arrow:1116611362861351045> **{m_item}** - **x{quantity}**\n"
-                        f"Reference Code: `{await generate_reference_code()}`\n\n"
-                        "<a:dot_blow:1139089076578947173> please read <#1100371712509493296> before and after purchasing.\n"
-                        f"<a:dot_blow:1139089076578947173> vouch at <#1095348388284862485> within **{convert_seconds_to_hours(await get_timer_value())}** to activate warranty.\n"
-                        "<a:dot_blow:1139089076578947173> don't forget to write the right format or else it will be voided.\n"
-                        "<a:dot_blow:1139089076578947173> no vouch = no warranty\n\n"
-                        "thank you so much for trusting us.\n"
-                        "balik po kayo\n\n"
-                        "love, calliope <:starguardian:1116890190003314749>\n\n"
-                        "(links)\n\n"
-                    )
-                    for idx, single_link in enumerate(m_link, start=1):
-                        message_template += f"||`{single_link}`||\n"
-
-                pending_embed = discord.Embed(
-                    title="Warranty Activation",
-                    description=f"The warranty activation has been sent to {user.mention}\n\n"
-                                f"**Note:** The warranty will be **AUTOMATICALLY** voided if {user.mention} doesn't vouch in <#{await get_vouch_channel_id()}> within **{convert_seconds_to_hours(await get_timer_value())}** of receiving the warranty activation message.\n\n"
-                                f"I will notify you if the user {user.mention} sent an image to the <#{await get_vouch_channel_id()}>.\n\n"
-                                f"Reference Code: `{reference_code}`\n"
-                                f"Due Date: `{deadline_ph.strftime('%Y-%m-%d %I:%M')} {deadline_ph.strftime('%p').upper()}`\n\n"
-                                f"Verifier: {ctx.author.mention}",
-                    color=0x00ffff)
-
-                await user.send(message_template)
-                await ctx.respond(f'Sending warranty activation message to the user. Let me cook for a minute.',
-                                  ephemeral=True)
-                pending_msg = await ctx.send(embed=pending_embed)
-
-                try:  # Subtract how much have been bought
-                    stocks_data[m_item] = int(stocks_data[m_item]) - int(m_quantity)
-                    saveJson(stocks_data, "stocks_data.json")
-                except asyncio.TimeoutError:  # If the user didn't enter number
-                    error = discord.Embed(
-                        title="Something went wrong",
-                        description="You encountered a rare bug! Please contact `@kensu`.",
-                        color=0xff0000
-                    )
-                    await ctx.send(embed=error)
-                    return
 
-                def image_check(message):
-                    return (
-                            message.author == user
-                            and message.channel == target_channel
-                            and any(
-                        attachment.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')) for attachment
-                        in message.attachments)
-                    )
+def unwatch_warranty(reference_code):
+    if reference_code in warranty_waits:
+        waits.unregister(*warranty_waits.pop(reference_code))
 
-                try:
-                    # Wait for the user to send an image message
-                    image_message = await bot.wait_for("message", timeout=await get_timer_value(), check=image_check)
-
-                    moderator_role = discord.utils.get(ctx.guild.roles, id=await get_moderator_id())
-
-                    # User sent an image
-                    notification_embed = discord.Embed(
-                        title="Vouch Notification",
-                        description=f"{moderator_role.mention}. The user {user.mention} has sent an image in the vouch channel.\n\n"
-                                    f"Before locking the order, please double-check it to ensure the following:\n"
-                                    f"- The user mentions {ctx.guild.owner.mention} or the other moderators.\n"
-                                    f"- The reference code must be visible from the screenshot.\n\n"
-                                    f"Reference code: `{reference_code}`\n\n"
-                                    f"Item: `{m_item}`\n"
-                                    f"Quantity: `{m_quantity}`\n\n",
-                        color=0xffa500
-                    )
 
-                    if image_message:
-                        image_link = image_message.jump_url
-                        notification_embed.description += f"[View Image]({image_link})"
+def close_warranty(reference_code):
+    unwatch_warranty(reference_code)
+    scheduler.cancel('warranty', reference_code)
+    return warranty_store.pop(reference_code)
 
-                    # Send the notification and add a lock emoji reaction
-                    notification_msg = await ctx.send(embed=notification_embed)
 
-                    await notification_msg.add_reaction("🔒")
+async def on_warranty_vouched(reference_code, image_message):
+    record = warranty_store.data.get(reference_code)
+    if record is None or record['state'] != 'sent':
+        return
+    if image_message.created_at.timestamp() > record['deadline']:
+        return  # Replayed from history after the warranty had already expired
+    unwatch_warranty(reference_code)
+    scheduler.cancel('warranty', reference_code)
+    record = update_warranty(reference_code, state='vouched', image_url=image_message.jump_url)
+    await ledger.set_state(reference_code, 'vouched')
+    try:
+        reused = await find_reused_images(reference_code, record, image_message)
+    except Exception as e:
+        # Only a hint for the moderators: it must never hold back the notification
+        print(f"Could not check the vouch images of warranty {reference_code}: {e!r}")
+        reused = []
+    if reused:
+        record = update_warranty(reference_code, reused_images=reused)
+    await send_vouch_notification(reference_code, record)
+
+
+async def send_vouch_notification(reference_code, record):
+    channel = bot.get_channel(record['channel_id'])
+    if channel is None:
+        # Kept as vouched, the notification goes out once the guild is available again
+        print(f"Could not notify the staff of warranty {reference_code}, their channel is not available.")
+        return
+    moderator_role = channel.guild.get_role(get_guild_state(channel.guild.id).config.moderator)
+
+    # User sent an image
+    notification_embed = discord.Embed(
+        title="Vouch Notification",
+        description=f"{moderator_role.mention if moderator_role else 'Moderators'}. The user <@{record['user_id']}> has sent an image in the vouch channel.\n\n"
+                    f"Before locking the order, please double-check it to ensure the following:\n"
+                    f"- The user mentions <@{channel.guild.owner_id}> or the other moderators.\n"
+                    f"- The reference code must be visible from the screenshot.\n\n"
+                    f"Reference code: `{reference_code}`\n\n"
+                    f"Item: `{record['item']}`\n"
+                    f"Quantity: `{record['quantity']}`\n\n"
+                    f"[View Image]({record['image_url']})",
+        color=0xffa500
+    )
+    if record.get('reused_images'):
+        notification_embed.add_field(
+            name="⚠️ Possibly Reused Screenshot",
+            value="\n".join(f"[Vouch]({match['url']}) by <@{match['user_id']}> for `{match['reference_code']}` "
+                            f"({match['distance']} bits apart)" for match in record['reused_images']),
+            inline=False)
+        notification_embed.color = 0xff0000
+
+    # Send the notification and add a lock emoji reaction
+    notification_msg = await channel.send(embed=notification_embed)
+    update_warranty(reference_code, notification_message_id=notification_msg.id)
+    watch_warranty(reference_code)
+    await notification_msg.add_reaction("🔒")
+
+
+async def on_warranty_locked(reference_code, moderator):
+    record = warranty_store.data.get(reference_code)
+    if record is None or record['state'] != 'vouched':
+        return
+    close_warranty(reference_code)
+    count_sale(record, 'activated')
+    await ledger.set_state(reference_code, 'activated', moderator.id)
+    channel = bot.get_channel(record['channel_id'])
+    if channel is None:
+        return
+
+    # Clear all reactions on the message
+    notification_msg = channel.get_partial_message(record['notification_message_id'])
+    await notification_msg.clear_reactions()
+
+    # Edit the notification to display "Warranty Activated"
+    success_embed = discord.Embed(
+        title="Warranty Activated",
+        description=f"The user <@{record['user_id']}> has successfully vouched.\n\n"
+                    f"**Order Information:**\n\n"
+                    f"Item: `{record['item']}`\n"
+                    f"Quantity: `{record['quantity']}`\n"
+                    f"Reference code: `{reference_code}`\n\n"
+                    f"Verified by: {moderator.mention}\n\n"
+                    f"[View Image]({record['image_url']})",
+        color=0x00ff00
+    )
+    await notification_msg.edit(embed=success_embed)
 
-                    moderator_id = await get_moderator_id()
+    # Change the color of the pending embed to green; bulk orders share one summary instead
+    if record.get('pending_message_id'):
+        pending_msg = channel.get_partial_message(record['pending_message_id'])
+        await pending_msg.edit(embed=warranty_pending_embed(record, reference_code, 0x00ff00))
 
-                    def check_reaction(reaction, user):
-                        role = ctx.guild.get_role(moderator_id)
-                        return (
-                                reaction.message.id == notification_msg.id
-                                and str(reaction.emoji) == "🔒"
-                                and role in user.roles
-                        )
 
-                    try:
-                        # Wait for a moderator to react with the lock emoji
-                        reaction, user = await bot.wait_for("reaction_add", check=check_reaction)
-
-                        # Clear all reactions on the message
-                        await notification_msg.clear_reactions()
-
-                        # Edit the success_embed to display "Warranty Activated"
-                        notification_embed.title = "Warranty Activated"
-                        notification_embed.description = (
-                            f"The user {user.mention} has successfully vouched.\n\n"
-                            f"**Order Information:**\n\n"
-                            f"Item: `{m_item}`\n"
-                            f"Quantity: `{m_quantity}`\n"
-                            f"Reference code: `{reference_code}`\n\n"
-                            f"Verified by: {user.mention}\n\n"
-                        )
-
-                        if image_message:
-                            image_link = image_message.jump_url
-                            notification_embed.description += f"[View Image]({image_link})"
-
-                        notification_embed.color = 0x00ff00
-                        await notification_msg.edit(embed=notification_embed)
-
-                        # Change the color of the pending embed to green
-                        pending_embed.color = 0x00ff00
-                        await pending_msg.edit(embed=pending_embed)
-
-                    except asyncio.TimeoutError:
-                        # If no moderator reacted
-                        pass
-
-                except asyncio.TimeoutError:
-                    # User did not send an image
-                    fail_embed = discord.Embed(
-                        title="Warranty Voided",
-                        description=f"The user {user.mention} did not submit a vouch or image within the provided {convert_seconds_to_hours(await get_timer_value())} time.\n"
-                                    f"Reference code: `{reference_code}`\n"
-                                    f"Verified by: `Automatically Voided`",
-                        color=0xff0000
-                    )
-                    await ctx.send(embed=fail_embed)
-
-                    # Change the color of the pending embed to red
-                    pending_embed.color = 0xff0000
-                    await pending_msg.edit(embed=pending_embed)
-            except discord.errors.Forbidden as e:
-                if e.status == 403:
-                    await ctx.respond(
-                        f"I'm sorry, but I'm unable to send a direct message to {user.mention}. Please inform them to check their privacy settings to enable direct messages.",
-                        ephemeral=True)
-                else:
-                    await ctx.respond(
-                        "Please contact the developer for assistance as you seem to have encountered a bug.",
-                        ephemeral=True)
-
-        await send_warranty(ctx, user)
-
-    if len(stocks_data) <= 0:
-        embed = discord.Embed(title="Stock Items", description="There are no items saved on my list.")
-        await ctx.respond(embed=embed, ephemeral=True)
+@scheduler.handler('warranty')
+async def void_warranty(reference_code):
+    record = warranty_store.data.get(reference_code)
+    if record is None or record['state'] != 'sent':
+        return
+    close_warranty(reference_code)
+    count_sale(record, 'voided')
+    await ledger.set_state(reference_code, 'voided')
+    channel = bot.get_channel(record['channel_id'])
+    if channel is None:
+        return
+
+    # User did not send an image
+    fail_embed = discord.Embed(
+        title="Warranty Voided",
+        description=f"The user <@{record['user_id']}> did not submit a vouch or image within the provided {convert_seconds_to_hours(record['due'])} time.\n"
+                    f"Reference code: `{reference_code}`\n"
+                    f"Verified by: `Automatically Voided`",
+        color=0xff0000
+    )
+    await channel.send(embed=fail_embed)
+
+    # Change the color of the pending embed to red
+    if record.get('pending_message_id'):
+        pending_msg = channel.get_partial_message(record['pending_message_id'])
+        await pending_msg.edit(embed=warranty_pending_embed(record, reference_code, 0xff0000))
+
+
+async def resume_warranties():
+    # Re-attach to every open warranty after a restart and catch up on events missed while offline
+    oldest_sent = {}
+    for reference_code, record in list(warranty_store.data.items()):
+        try:
+            if record['state'] == 'vouched' and not record.get('notification_message_id'):
+                await send_vouch_notification(reference_code, record)
+                continue
+            watch_warranty(reference_code)
+            if record['state'] == 'sent':
+                # A deadline that fired just before a crash is scheduled again, already past due
+                scheduler.schedule('warranty', reference_code, record['deadline'], record['guild_id'])
+                channel_id = record['vouch_channel']
+                oldest_sent[channel_id] = min(oldest_sent.get(channel_id, record['created_at']),
+                                              record['created_at'])
+            elif record['state'] == 'vouched':
+                await resume_lock_reaction(reference_code, record)
+        except Exception as e:
+            # One broken warranty must not leave the ones after it unwatched
+            print(f"Could not resume warranty {reference_code}: {e!r}")
+
+    for channel_id, created_at in oldest_sent.items():
+        vouch_channel = bot.get_channel(channel_id)
+        if vouch_channel is None:
+            continue
+        after = datetime.datetime.fromtimestamp(created_at, datetime.timezone.utc)
+        try:
+            async for message in vouch_channel.history(after=after, limit=None):
+                waits.dispatch("message", (message.channel.id, message.author.id), message)
+        except discord.HTTPException as e:
+            print(f"Could not read the history of #{vouch_channel.name}: {e}")
+
+
+@bot.listen()
+async def on_guild_available(guild):
+    # The guild was unavailable for a while: send the notifications of the vouches that came in meanwhile
+    for reference_code, record in list(warranty_store.data.items()):
+        if record['guild_id'] != guild.id or record['state'] != 'vouched' or record.get('notification_message_id'):
+            continue
+        try:
+            await send_vouch_notification(reference_code, record)
+        except Exception as e:
+            print(f"Could not notify the staff of warranty {reference_code}: {e!r}")
+
+
+async def start_deadlines():
+    # Deadlines that passed while the bot was offline only fire once the vouches posted before them have
+    # been replayed, or a buyer who vouched in time would be voided
+    await resume_warranties()
+    await scheduler.run()
+
+
+async def resume_lock_reaction(reference_code, record):
+    channel = bot.get_channel(record['channel_id'])
+    if channel is None:
+        return
+    try:
+        notification_msg = await channel.fetch_message(record['notification_message_id'])
+        for reaction in notification_msg.reactions:
+            if str(reaction.emoji) != "🔒" or reaction.count <= 1:
+                continue
+            async for reactor in reaction.users():
+                if reactor.id == bot.user.id:
+                    continue
+                member = await fetch_member(channel.guild, reactor.id)
+                if member is None:
+                    continue
+                moderator_id = get_guild_state(channel.guild.id).config.moderator
+                if discord.utils.get(member.roles, id=moderator_id) is not None:
+                    await on_warranty_locked(reference_code, member)
+                    return
+    except discord.HTTPException as e:
+        print(f"Could not check the lock reaction of warranty {reference_code}: {e}")
+
+
+WARRANTY_MESSAGE = (
+    "**.별 : a message has been received.**\n\n"
+    "<a:pink_arrow:1116611362861351045> **{item}** - **x{quantity}**\n"
+    "Reference Code: `{reference_code}`\n\n"
+    "<a:dot_blow:1139089076578947173> please read <#1100371712509493296> before and after purchasing.\n"
+    "<a:dot_blow:1139089076578947173> vouch at <#1095348388284862485> within **{due}** to activate warranty.\n"
+    "<a:dot_blow:1139089076578947173> don't forget to write the right format or else it will be voided.\n"
+    "<a:dot_blow:1139089076578947173> no vouch = no warranty\n\n"
+    "thank you so much for trusting us.\n"
+    "balik po kayo\n\n"
+    "love, calliope <:starguardian:1116890190003314749>"
+)
+
+
+async def send_warranty(ctx, user, item, quantity, link):
+    reference_code = generate_reference_code()
+
+    # Get the current date, and the configured timer
+    state = get_guild_state(ctx.guild.id)
+    created_at = time.time()
+    due = state.config.due
+
+    message_template = WARRANTY_MESSAGE.format(item=item, quantity=quantity, reference_code=reference_code,
+                                               due=convert_seconds_to_hours(due))
+    if link != '':
+        message_template += "\n\n(links)\n\n" + "".join(f"||`{single_link}`||\n" for single_link in link.split())
+
+    # Take the stock first so concurrent orders can never push it below zero
+    released = await commit_stock(state, item, int(quantity), user.id)
+    if released is None:
+        await ctx.respond(
+            embed=discord.Embed(
+                title="Not Enough Stock",
+                description=f"There are only `{available_stock(state, item)}` of `{item}` available.",
+                color=0xff0000
+            ),
+            ephemeral=True)
+        return
+
+    try:
+        await user.send(message_template)
+    except discord.HTTPException as e:
+        # The order did not go through, give the stock and the buyer's reservations back
+        await refund_stock(state, {item: int(quantity)}, released)
+        if isinstance(e, discord.Forbidden) and e.status == 403:
+            await ctx.respond(
+                f"I'm sorry, but I'm unable to send a direct message to {user.mention}. Please inform them to check their privacy settings to enable direct messages.",
+                ephemeral=True)
+        else:
+            await ctx.respond(
+                f"I couldn't send the warranty activation message to {user.mention} (error {e.status}). No stock was taken, please try again.",
+                ephemeral=True)
+        return
+
+    # The buyer has their reference code now, so the order is recorded whatever happens in this channel
+    record = {
+        'state': 'sent',
+        'guild_id': ctx.guild.id,
+        'channel_id': ctx.channel.id,
+        'vouch_channel': state.config.vouch_channel,
+        'user_id': user.id,
+        'verifier_id': ctx.user.id,
+        'item': item,
+        'quantity': quantity,
+        'due': due,
+        'created_at': created_at,
+        'deadline': created_at + due,
+        'pending_message_id': None,
+    }
+    warranty_store.set(reference_code, record)
+    await ledger.add(reference_code, record)
+    count_sale(record, 'warrantied')
+    watch_warranty(reference_code)
+    scheduler.schedule('warranty', reference_code, record['deadline'], record['guild_id'])
+
+    await ctx.respond(f'Sending warranty activation message to the user. Let me cook for a minute.',
+                      ephemeral=True)
+    try:
+        pending_msg = await ctx.channel.send(embed=warranty_pending_embed(record, reference_code))
+    except discord.HTTPException as e:
+        print(f"Warranty {reference_code} was sent, but its pending message could not be posted: {e!r}")
+        return
+    update_warranty(reference_code, pending_message_id=pending_msg.id)
+
+
+@bot.slash_command(description="Send a warranty activation message to a user.")
+@has_required_role()
+async def warranty(ctx: commands.Context, user: discord.User,
+                   item: discord.Option(str, "The item that has been bought", autocomplete=item_autocomplete,
+                                        required=False, default=None)):
+    async def get_modal_variables(quantity, link, item):
+        await send_warranty(ctx, user, item, quantity, link)
+
+    state = get_guild_state(ctx.guild.id)
+    if item is not None:
+        if item not in state.stocks_data:
+            await respond_unknown_item(ctx, item)
+            return
+        await warranty_item_picker(get_modal_variables)(ctx.interaction, item)
+        return
+    if len(state.stocks_data) <= 0:
+        await ctx.respond(embed=templates.render('empty catalog'), ephemeral=True)
         return
     else:
         await ctx.respond("Select the item that has been bought.",
-                          view=ViewWarrantyButtons(stocks_data, get_modal_variables),
+                          view=StockPager(state, 'warranty', user.id),
                           ephemeral=True)
 
 
-@bot.slash_command(description="Retrieve and display the current configuration settings of the bot.")
+# Sales Analytics
+# Every warranty sent, activated or voided adds its units to a counter for the day the order was sent,
+# the verifier who sent it and the item, kept with the guild's other state. /report only sums the
+# counters in range, so it costs the same after a year of orders as after a week.
+
+SALE_EVENTS = ('warrantied', 'activated', 'voided')
+REPORT_GROUPS = ('item', 'day', 'verifier')
+REPORT_ROWS = 20  # Rows shown in the embed, the CSV has them all
+CHART_WIDTH = 12
+
+
+def index_sales(state, key):
+    day = key.split('|', 1)[0]
+    if day not in state.sales_days:
+        state.sales_days[day] = []
+        bisect.insort(state.sales_day_order, day)
+    state.sales_days[day].append(key)
+
+
+def count_sale(record, event):
+    state = get_guild_state(record['guild_id'])
+    day = datetime.datetime.fromtimestamp(record['created_at'], ph_timezone).strftime('%Y-%m-%d')
+    key = f"{day}|{record['verifier_id']}|{record['item']}"
+    if key not in state.analytics_store.data:
+        index_sales(state, key)
+    counts = state.analytics_store.data.get(key, {})
+    state.analytics_store.set(key, {**counts, event: counts.get(event, 0) + int(record['quantity'])})
+
+
+def sales_report(state, since, group):
+    # {group value: {event: units}} over the days from since (YYYY-MM-DD) on; only those days are read
+    rows = {}
+    for day in state.sales_day_order[bisect.bisect_left(state.sales_day_order, since):]:
+        for key in state.sales_days[day]:
+            counts = state.analytics_store.data[key]
+            _, verifier_id, item = key.split('|', 2)
+            row = rows.setdefault({'item': item, 'day': day, 'verifier': verifier_id}[group],
+                                  dict.fromkeys(SALE_EVENTS, 0))
+            for event in SALE_EVENTS:
+                row[event] += counts.get(event, 0)
+    if group == 'day':
+        return dict(sorted(rows.items()))
+    return dict(sorted(rows.items(), key=lambda row: -row[1]['warrantied']))
+
+
+def vouch_rate(row):
+    resolved = row['activated'] + row['voided']
+    return f"{row['activated'] * 100 // resolved}%" if resolved else "-"
+
+
+def chart_bar(value, largest):
+    filled = round(value * CHART_WIDTH / largest) if largest else 0
+    return "█" * filled + "░" * (CHART_WIDTH - filled)
+
+
+def report_csv(rows, group):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow([group, *SALE_EVENTS, 'vouch_rate'])
+    for name, row in rows.items():
+        writer.writerow([name, *(row[event] for event in SALE_EVENTS), vouch_rate(row)])
+    return output.getvalue().encode()
+
+
+@bot.slash_command(description="Show how many items were warrantied, activated and voided.")
 @has_required_role()
-async def settings(ctx: commands.Context):
-    guild = ctx.guild
-    guild_owner = guild.owner if guild else None
-    moderator_role = discord.utils.get(ctx.guild.roles, id=await get_moderator_id())
+async def report(ctx: commands.Context,
+                 days: discord.Option(int, "How many days back", min_value=1, max_value=3660, default=30),
+                 group: discord.Option(str, "Group the numbers by", choices=REPORT_GROUPS, default='item'),
+                 attach_csv: discord.Option(bool, "Attach every row as a CSV file", default=False)):
+    state = get_guild_state(ctx.guild.id)
+    today = datetime.datetime.now(ph_timezone).date()
+    since = (today - datetime.timedelta(days=days - 1)).isoformat()
+    rows = sales_report(state, since, group)
+    if not rows:
+        await ctx.respond(f"There were no orders in the last {days} days.", ephemeral=True)
+        return
+
+    totals = {event: sum(row[event] for row in rows.values()) for event in SALE_EVENTS}
+    largest = max(row['warrantied'] for row in rows.values())
+    lines = []
+    for name, row in list(rows.items())[:REPORT_ROWS]:
+        label = f"<@{name}>" if group == 'verifier' else f"`{name}`"
+        lines.append(f"{label}\n`{chart_bar(row['warrantied'], largest)}` {row['warrantied']} sold · "
+                     f"{row['activated']} activated · {row['voided']} voided · {vouch_rate(row)} vouched")
+    if len(rows) > REPORT_ROWS:
+        lines.append(f"...and {len(rows) - REPORT_ROWS} more")
+    embed = discord.Embed(
+        title=f"Sales Report · last {days} days",
+        description="\n".join(lines),
+        color=0x3498db
+    )
+    embed.add_field(name="Warrantied", value=f"`{totals['warrantied']}`")
+    embed.add_field(name="Activated", value=f"`{totals['activated']}`")
+    embed.add_field(name="Voided", value=f"`{totals['voided']}`")
+    embed.add_field(name="Vouch rate", value=f"`{vouch_rate(totals)}`")
+    embed.set_footer(text=f"Grouped by {group}, days in Asia/Manila time")
+    csv_file = None
+    if attach_csv:
+        csv_file = discord.File(io.BytesIO(report_csv(rows, group)), filename=f"report-{group}-{since}.csv")
+    await ctx.respond(embed=embed, file=csv_file, ephemeral=True)
+
+
+# Bulk Warranty
+# A whole list of orders at once: the stock for all of them is taken in one transaction, the DMs go
+# out through a few workers so a long list stays inside Discord's DM rate limits, and the channel gets
+# one summary instead of a pending embed per order.
+
+BULK_MAX_ORDERS = 200
+BULK_FILE_LIMIT = 256 * 1024  # Bytes
+DM_WORKERS = 3
+DM_INTERVAL = 1.0  # Seconds each worker waits between DMs
+dm_slots = asyncio.Semaphore(DM_WORKERS)  # Shared by every bulk run so two of them cannot double the rate
+
+
+def parse_bulk_orders(text):
+    # One order per line: user (id or mention), item, quantity, links (optional, space separated)
+    orders, errors = [], []
+    for line_number, row in enumerate(csv.reader(io.StringIO(text)), 1):
+        cells = [cell.strip() for cell in row]
+        if not any(cells) or (line_number == 1 and cells[0].lower() == 'user'):
+            continue
+        user_id = cells[0].removeprefix('<@').removeprefix('!').removesuffix('>')
+        if len(cells) < 3 or not user_id.isdigit() or not cells[2].isdigit() or int(cells[2]) <= 0:
+            errors.append(f"Line {line_number}: expected `user, item, quantity, links`")
+            continue
+        orders.append({'user_id': int(user_id), 'item': cells[1], 'quantity': int(cells[2]),
+                       'link': ' '.join(cells[3:])})
+    return orders, errors
+
+
+async def deliver_warranty(order, message):
+    async with dm_slots:
+        try:
+            user = bot.get_user(order['user_id']) or await bot.fetch_user(order['user_id'])
+            await user.send(message)
+            return None
+        except discord.Forbidden:
+            return "Forbidden"
+        except discord.NotFound:
+            return "Unknown user"
+        except discord.HTTPException as e:
+            return f"Failed ({e.status})"
+        finally:
+            await asyncio.sleep(DM_INTERVAL)
+
+
+async def send_bulk_warranty(interaction, text):
+    guild = interaction.guild
+    state = get_guild_state(guild.id)
+    orders, errors = parse_bulk_orders(text)
+    if len(orders) > BULK_MAX_ORDERS:
+        errors.append(f"Only the first {BULK_MAX_ORDERS} orders were sent.")
+        orders = orders[:BULK_MAX_ORDERS]
+    for order in orders:
+        if order['item'] not in state.stocks_data:
+            order['result'] = "Unknown item"
+
+    pending = [order for order in orders if 'result' not in order]
+    granted = await commit_stock_many(state, [(order['item'], order['quantity'], order['user_id'])
+                                              for order in pending])
+    for order, released in zip(pending, granted):
+        if released is None:
+            order['result'] = "Not enough stock"
+        else:
+            order['released'] = released
+
+    created_at = time.time()
+    due = state.config.due
+    sending = [order for order in orders if 'result' not in order]
+    for order in sending:
+        order['reference_code'] = generate_reference_code()
+    messages = []
+    for order in sending:
+        message = WARRANTY_MESSAGE.format(item=order['item'], quantity=order['quantity'],
+                                          reference_code=order['reference_code'], due=convert_seconds_to_hours(due))
+        if order['link'] != '':
+            message += "\n\n(links)\n\n" + "".join(f"||`{single_link}`||\n" for single_link in order['link'].split())
+        messages.append(message)
+    failures = await asyncio.gather(*[deliver_warranty(order, message) for order, message in zip(sending, messages)])
+
+    # Orders that could not be delivered give their stock and reservations back, again in one transaction
+    refunds, released = {}, []
+    records = {}
+    for order, failure in zip(sending, failures):
+        if failure is not None:
+            order['result'] = failure
+            refunds[order['item']] = refunds.get(order['item'], 0) + order['quantity']
+            released.extend(order['released'])
+            continue
+        order['result'] = None
+        records[order['reference_code']] = {
+            'state': 'sent',
+            'guild_id': guild.id,
+            'channel_id': interaction.channel.id,
+            'vouch_channel': state.config.vouch_channel,
+            'user_id': order['user_id'],
+            'verifier_id': interaction.user.id,
+            'item': order['item'],
+            'quantity': str(order['quantity']),
+            'due': due,
+            'created_at': created_at,
+            'deadline': created_at + due,
+            'pending_message_id': None,
+        }
+    if refunds:
+        await refund_stock(state, refunds, released)
+    for reference_code, record in records.items():
+        warranty_store.set(reference_code, record)
+        count_sale(record, 'warrantied')
+        watch_warranty(reference_code)
+        scheduler.schedule('warranty', reference_code, record['deadline'], record['guild_id'])
+    if records:
+        await ledger.add_many(records)
+
+    lines = []
+    for order in orders:
+        if order['result'] is None:
+            lines.append(f"✅ <@{order['user_id']}> `{order['item']}` x{order['quantity']} - `{order['reference_code']}`")
+        else:
+            lines.append(f"❌ <@{order['user_id']}> `{order['item']}` x{order['quantity']} - {order['result']}")
+    lines.extend(f"⚠️ {error}" for error in errors)
+    description = ""
+    for index, line in enumerate(lines):
+        if len(description) + len(line) > 3900:
+            description += f"...and {len(lines) - index} more"
+            break
+        description += line + "\n"
+    summary = discord.Embed(
+        title="Bulk Warranty",
+        description=description or "There were no orders in the list.",
+        color=0xffa500 if records else 0xff0000
+    )
+    summary.set_footer(text=f"{len(records)} of {len(orders)} warranty messages sent, "
+                            f"vouch within {convert_seconds_to_hours(due)}")
+    await interaction.channel.send(embed=summary)
+    await interaction.followup.send(f"Sent {len(records)} of {len(orders)} warranty messages.", ephemeral=True)
+
+
+class BulkWarrantyModal(discord.ui.Modal):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.add_item(discord.ui.InputText(label="Orders", placeholder='user, item, quantity, links (one per line)',
+                                           style=discord.InputTextStyle.long, required=True))
+
+    async def callback(self, interaction: discord.Interaction):
+        await interaction.response.defer(ephemeral=True)
+        await send_bulk_warranty(interaction, self.children[0].value)
+
+
+@bot.slash_command(description="Send warranty activation messages for a list of orders.")
+@has_required_role()
+async def warranty_bulk(ctx: commands.Context,
+                        orders: discord.Option(discord.Attachment, "CSV file with user, item, quantity, links",
+                                               required=False, default=None)):
+    if orders is None:
+        await ctx.send_modal(BulkWarrantyModal(title="Bulk Warranty"))
+        return
+    if orders.size > BULK_FILE_LIMIT:
+        await ctx.respond(f"The file is too big, keep it under {BULK_FILE_LIMIT // 1024} KB.", ephemeral=True)
+        return
+    await ctx.defer(ephemeral=True)
+    await send_bulk_warranty(ctx.interaction, (await orders.read()).decode('utf-8-sig', errors='replace'))
+
+
+@templates.template('settings')
+def settings_template(scope):
     embed = discord.Embed(
         title="Bot Configuration",
         description="Here is the current configuration of the bot\n",
         color=0x3498db  # Blue color
     )
-    embed.add_field(name="⌛ Timer", value=f"`{await get_timer_value() // 3600} hours`", inline=False)
-    embed.add_field(name="🧾 Vouch Channel", value=f"`#{ctx.guild.get_channel(await get_vouch_channel_id()).name}`",
-                    inline=False)
-    embed.add_field(name="🏰 Server Name", value=f"`{guild.name}`" if guild else "`Not in a guild`", inline=False)
-    embed.add_field(name="👑 Server Owner", value=f"`@{guild_owner.name}`" if guild_owner else "N/A", inline=False)
-    embed.add_field(name="🎟 Ticket Channel", value=f"`#{ctx.guild.get_channel(await get_category_id()).name}`",
-                    inline=False)
-    embed.add_field(name="🤖 Authorized Role", value=f"`@{moderator_role.name}`",
-                    inline=False)
+    embed.add_field(name="⌛ Timer", value="{timer}", inline=False)
+    embed.add_field(name="🧾 Vouch Channel", value="{vouch_channel}", inline=False)
+    embed.add_field(name="🏰 Server Name", value="{server}", inline=False)
+    embed.add_field(name="👑 Server Owner", value="{owner}", inline=False)
+    embed.add_field(name="🎟 Ticket Channel", value="{category}", inline=False)
+    embed.add_field(name="🤖 Authorized Role", value="{role}", inline=False)
+    return embed
+
+
+@bot.slash_command(description="Retrieve and display the current configuration settings of the bot.")
+@has_required_role()
+async def settings(ctx: commands.Context):
+    guild = ctx.guild
+    guild_owner = await fetch_member(guild, guild.owner_id) if guild else None
+    guild_config = get_guild_state(guild.id).config
+    moderator_role = discord.utils.get(ctx.guild.roles, id=guild_config.moderator)
+    vouch_channel = ctx.guild.get_channel(guild_config.vouch_channel)
+    ticket_category = ctx.guild.get_channel(guild_config.category)
+    embed = templates.render(
+        'settings',
+        timer=f"`{guild_config.due // 3600} hours`",
+        vouch_channel=f"`#{vouch_channel.name}`" if vouch_channel else "`Not set`",
+        server=f"`{guild.name}`" if guild else "`Not in a guild`",
+        owner=f"`@{guild_owner.name}`" if guild_owner else "N/A",
+        category=f"`#{ticket_category.name}`" if ticket_category else "`Not set`",
+        role=f"`@{moderator_role.name}`" if moderator_role else "`Not set`",
+    )
     await ctx.respond(embed=embed)
 
 
@@ -746,8 +3279,7 @@ async def channel(ctx: commands.Context, channel: discord.TextChannel):
     )
     await ctx.respond(embed=embed)
 
-    # Replace the variable on .env file
-    await replace_env_variable('.env', 'VOUCH_CHANNEL', channel.id)
+    get_guild_state(ctx.guild.id).config.set('vouch_channel', channel.id)
 
 
 @bot.slash_command(description="Modify the roles that have access to use the bot. (Restricted to administrators)")
@@ -760,15 +3292,13 @@ async def moderator(ctx: commands.Context, role: discord.Role):
     )
     await ctx.respond(embed=embed)
 
-    # Replace the variable on .env file
-    await replace_env_variable('.env', 'MODERATOR', role.id)
+    get_guild_state(ctx.guild.id).config.set('moderator', role.id)
 
 
 @bot.slash_command(description="Specify the category where new support tickets will be created.")
 @has_required_role()
 async def category(ctx: commands.Context, category: discord.CategoryChannel):
-    # Replace the variable on .env file
-    await replace_env_variable('.env', 'CATEGORY', category.id)
+    get_guild_state(ctx.guild.id).config.set('category', category.id)
 
     embed = discord.Embed(
         title="Vouch Channel Updated",
@@ -784,7 +3314,7 @@ async def timer(ctx: commands.Context, hours: int):
     if hours < 0:
         await ctx.respond("Please enter a number.")
         return
-    await replace_env_variable('.env', 'DUE', hours * 3600)
+    get_guild_state(ctx.guild.id).config.set('due', hours * 3600)
     embed = discord.Embed(
         title="Timer Updated",
         description=f"The timer has been set to **{hours}** hour/s.",
@@ -793,13 +3323,43 @@ async def timer(ctx: commands.Context, hours: int):
     await ctx.respond(embed=embed)
 
 
+async def resolve_order(ctx, user, reference_code, state, color):
+    # Look the order up in the ledger, close it if it is still open and record the final state
+    order = await ledger.find(ctx.guild.id, reference_code.strip().upper())
+    if order is None or order['user_id'] != user.id:
+        embed = discord.Embed(
+            title="Order Not Found",
+            description=f"There is no order with the reference code `{reference_code}` for {user.mention}.",
+            color=0xff0000
+        )
+        await ctx.respond(embed=embed, ephemeral=True)
+        return None
+
+    reference_code = order['reference_code']
+    record = warranty_store.data.get(reference_code)
+    if record is not None:
+        close_warranty(reference_code)
+        count_sale(record, state)
+        channel = bot.get_channel(record['channel_id'])
+        if channel is not None and record.get('pending_message_id'):
+            pending_msg = channel.get_partial_message(record['pending_message_id'])
+            await pending_msg.edit(embed=warranty_pending_embed(record, reference_code, color))
+    await ledger.set_state(reference_code, state, ctx.author.id)
+    return order
+
+
 @bot.slash_command(description="Sends an activated warranty message to the specified user.")
 @has_required_role()
 async def warranty_activated(ctx: commands.Context, user: discord.User, reference_code):
+    order = await resolve_order(ctx, user, reference_code, 'activated', 0x00ff00)
+    if order is None:
+        return
     success_embed = discord.Embed(
         title="Warranty Activated",
         description=f"The user {user.mention} has successfully vouched.\n"
-                    f"Reference code: `{reference_code}`\n"
+                    f"Item: `{order['item']}`\n"
+                    f"Quantity: `{order['quantity']}`\n"
+                    f"Reference code: `{order['reference_code']}`\n"
                     f"Verified by: {ctx.author.mention}",
         color=0x00ff00
     )
@@ -809,55 +3369,147 @@ async def warranty_activated(ctx: commands.Context, user: discord.User, referenc
 @bot.slash_command(description="Sends a voided warranty message to the specified user.")
 @has_required_role()
 async def warranty_voided(ctx: commands.Context, user: discord.User, reference_code):
+    order = await resolve_order(ctx, user, reference_code, 'voided', 0xff0000)
+    if order is None:
+        return
     fail_embed = discord.Embed(
         title="Warranty Voided",
         description=f"The user {user.mention} did not submit a vouch.\n"
-                    f"Reference code: `{reference_code}`\n"
+                    f"Item: `{order['item']}`\n"
+                    f"Quantity: `{order['quantity']}`\n"
+                    f"Reference code: `{order['reference_code']}`\n"
                     f"Verified by: {ctx.author.mention}",
         color=0xff0000
     )
     await ctx.respond(embed=fail_embed)
 
 
-@bot.slash_command(description="This command will generate a templated message for the payment method you are using.")
+@bot.slash_command(description="Look up the latest orders of a user or an item.")
 @has_required_role()
-async def payment1(ctx: commands.Context):
-    await ctx.respond(f'Sending payment method message. Let me cook for a sec.', ephemeral=True)
-    space = "‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ "
-    payment_embed = discord.Embed(
-        title=f"{space}Payment Details !{space}",
+async def orders(ctx: commands.Context,
+                 user: discord.Option(discord.User, "The buyer", required=False, default=None),
+                 item: discord.Option(str, "The item", autocomplete=item_autocomplete, required=False,
+                                      default=None)):
+    if user is None and item is None:
+        await ctx.respond("Please choose a user or an item.", ephemeral=True)
+        return
+    rows = await ledger.latest(ctx.guild.id, user_id=user.id if user else None, item=item)
+    embed = discord.Embed(
+        title="Orders",
+        description=f"Latest orders of {user.mention if user else f'`{item}`'}\n\n",
+        color=0x3498db
+    )
+    if not rows:
+        embed.description += "No orders found."
+    for order in rows:
+        created = format_deadline(order['created_at'])
+        embed.description += (f"`{order['reference_code']}` - `{order['item']}` x{order['quantity']} - "
+                              f"<@{order['user_id']}> - **{order['state']}** - `{created}`\n")
+    await ctx.respond(embed=embed, ephemeral=True)
+
+
+# Payment Methods
+# Each guild keeps its payment methods as data; one /payment command renders whichever is picked.
+
+DEFAULT_PAYMENT_METHODS = {
+    'gcash-mc': {'label': 'GCASH PAYMENT', 'account': '09057868221 - m.c.'},
+    'gcash-mra': {'label': 'GCASH PAYMENT', 'account': '09690600063 - MRA'},
+}
+PAYMENT_SPACE = "‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ "
+
+
+def migrate_payment_methods(state):
+    # The methods /payment had built in before they became data, added once to the guild they belonged to
+    if state.config.store.data.get('payment_methods_migrated'):
+        return
+    if not state.payment_store.data:
+        for name, method in DEFAULT_PAYMENT_METHODS.items():
+            state.payment_store.set(name, method)
+    state.config.set('payment_methods_migrated', True)
+
+
+@templates.template('payment')
+def payment_template(scope):
+    guild_id, name = scope
+    method = get_guild_state(guild_id).payment_store.data[name]
+    return discord.Embed(
+        title=f"{PAYMENT_SPACE}Payment Details !{PAYMENT_SPACE}",
         description=f"‎ \n"
-                    f"{space}별 : **GCASH PAYMENT**{space}\n\n"
-                    f"{space}星 : **09057868221 - m.c.**{space}\n\n"
+                    f"{PAYMENT_SPACE}별 : **{method['label']}**{PAYMENT_SPACE}\n\n"
+                    f"{PAYMENT_SPACE}星 : **{method['account']}**{PAYMENT_SPACE}\n\n"
                     f"<a:pink_arrow:1116611362861351045> no receipt, no proc.\n",
         color=0xffc0cb
     )
-    await ctx.send(embed=payment_embed)
+
+
+async def payment_autocomplete(ctx: discord.AutocompleteContext):
+    query = (ctx.value or '').lower()
+    names = get_guild_state(ctx.interaction.guild_id).payment_store.data
+    return [name for name in names if query in name.lower()][:ItemIndex.MAX_RESULTS]
 
 
 @bot.slash_command(description="This command will generate a templated message for the payment method you are using.")
 @has_required_role()
-async def payment2(ctx: commands.Context):
+async def payment(ctx: commands.Context,
+                  method: discord.Option(str, "The payment method", autocomplete=payment_autocomplete)):
+    if method not in get_guild_state(ctx.guild.id).payment_store.data:
+        await ctx.respond(f"There is no payment method called `{method}`. Add it with `/payment_method`.",
+                          ephemeral=True)
+        return
     await ctx.respond(f'Sending payment method message. Let me cook for a sec.', ephemeral=True)
-    space = "‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ ‎ "
-    payment_embed = discord.Embed(
-        title=f"{space}Payment Details !{space}",
-        description=f"‎ \n"
-                    f"{space}별 : **GCASH PAYMENT**{space}\n\n"
-                    f"{space}星 : **09690600063 - MRA**{space}\n\n"
-                    f"<a:pink_arrow:1116611362861351045> no receipt, no proc.\n",
-        color=0xffc0cb
-    )
-    await ctx.send(embed=payment_embed)
+    await ctx.send(embed=templates.render('payment', (ctx.guild.id, method)))
 
 
-@bot.slash_command(description="List of available commands.")
+@bot.slash_command(description="Add, change or remove (leave the account empty) a payment method.")
 @has_required_role()
-async def help(ctx):
+async def payment_method(ctx: commands.Context,
+                         name: discord.Option(str, "Name of the payment method", autocomplete=payment_autocomplete),
+                         account: discord.Option(str, "Number and account holder, e.g. 09057868221 - m.c.",
+                                                 required=False, default=None),
+                         label: discord.Option(str, "Payment service", required=False,
+                                               default='GCASH PAYMENT')):
+    payment_store = get_guild_state(ctx.guild.id).payment_store
+    if account is None:
+        if name in payment_store.data:
+            payment_store.pop(name)
+        await ctx.respond(f"The payment method `{name}` has been removed.", ephemeral=True)
+        return
+    payment_store.set(name, {'label': label, 'account': account})
+    await ctx.respond(f"The payment method `{name}` has been saved.", ephemeral=True)
+
+
+@bot.slash_command(description="Show latency, event-loop and rate-limit diagnostics. (Restricted to administrators)")
+@discord.default_permissions(administrator=True)
+async def diag(ctx: commands.Context):
+    if not ctx.author.guild_permissions.administrator:
+        await respond_missing_role(ctx)
+        return
+    embed = discord.Embed(title="Diagnostics", color=0x3498db)
+    embed.description = "\n".join(f"{name.replace('_', ' ').capitalize()}: `{value}`"
+                                   for name, value in gauges().items())
+    rate_limited = ", ".join(f"{label} {value}" for (metric, label), value in counters.items()
+                             if metric == 'rate_limited')
+    embed.add_field(name="429 responses", value=rate_limited or "None", inline=False)
+    if not config.metrics:
+        embed.add_field(name="Latency", value="Set `METRICS=1` in .env to record latencies.", inline=False)
+    for metric, title in (('loop_lag', "Event loop lag"), ('command', "Commands"), ('component', "Buttons and menus"),
+                          ('event', "Gateway events"), ('disk', "Disk writes"), ('thread', "Worker threads")):
+        rows = sorted(((label, histogram) for (name, label), histogram in histograms.items() if name == metric),
+                      key=lambda row: -row[1].quantile(0.99))[:8]
+        if rows:
+            embed.add_field(name=title, value="\n".join(
+                f"`{label}` {format_latency(histogram)}" if label is not None else format_latency(histogram)
+                for label, histogram in rows)[:1024], inline=False)
+    await ctx.respond(embed=embed, ephemeral=True)
+
+
+@templates.template('help')
+def help_template(scope):
     embed = discord.Embed(title='Bot Commands', description='List of available commands:', color=discord.Color.blue())
 
     # Add commands and their functions
     embed.add_field(name='/stock', value='Display a list of items currently in stock.', inline=False)
+    embed.add_field(name='/board', value='Post a live stock board that the bot keeps up to date.', inline=False)
     embed.add_field(name='/new', value='Create a new item from the stock list.', inline=False)
     embed.add_field(name='/delete', value='Remove a specific item from the stock list.', inline=False)
     embed.add_field(name='/edit', value='Modify the name and quantity of a specific item in the stock list.',
@@ -873,17 +3525,35 @@ async def help(ctx):
     embed.add_field(name='/timer',
                     value='Adjust the duration (in hours) for the Warranty Verification process.', inline=False)
     embed.add_field(name='/warranty', value='Send a warranty activation message to a user.', inline=False)
+    embed.add_field(name='/warranty_bulk', value='Send warranty messages for a list of orders (CSV or form).',
+                    inline=False)
+    embed.add_field(name='/report', value='Show units warrantied, activated and voided with vouch rates.',
+                    inline=False)
     embed.add_field(name='/warranty_activated',
                     value='Sends an activated warranty message for the specified user.',
                     inline=False)
     embed.add_field(name='/warranty_voided', value='Sends a voided warranty message for the specified user.',
                     inline=False)
-    embed.add_field(name='/payment1', value='Generate a templated message for the gcash number 09057868221.',
+    embed.add_field(name='/orders', value='Look up the latest orders of a user or an item.', inline=False)
+    embed.add_field(name='/transcript', value="Fetch the archived transcripts of a buyer's tickets or of an order.",
                     inline=False)
-    embed.add_field(name='/payment2', value='Generate a templated message for the gcash number 09690600063.',
+    embed.add_field(name='/payment', value='Generate a templated message for one of the saved payment methods.',
                     inline=False)
-    await ctx.respond(embed=embed)
+    embed.add_field(name='/payment_method', value='Add, change or remove a payment method.', inline=False)
+    embed.add_field(name='/diag', value='Show latency, event-loop and rate-limit diagnostics.', inline=False)
+    return embed
+
+
+@bot.slash_command(description="List of available commands.")
+@has_required_role()
+async def help(ctx):
+    await ctx.respond(embed=templates.render('help'))
 
 
 # Run the bot
-bot.run(TOKEN)
+if __name__ == '__main__':
+    mark_startup('import')
+    bot.run(TOKEN)
+    flush_all_stores()
+    if hash_pool is not None:
+        hash_pool.shutdown()